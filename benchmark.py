@@ -0,0 +1,73 @@
+import time
+import torch
+import multiprocessing as mp
+from data import create_dataloader, DevicePrefetcher
+from trainer.trainer import Trainer
+from options.train_options import TrainOptions
+from utils import setup_cpu
+
+
+"""
+Training throughput for several cpu settings, takes the options of train.py plus:
+python benchmark.py --real_list_path ... --fake_list_path ... --gpu_ids -1 \
+    --configs 0:0:0:0,16:1:4:4,8:2:8:8 --steps 20
+Every config is intra_threads:interop_threads:num_threads:loader_cores (0: PyTorch default / no
+workers / no pinning) and runs in its own process, the inter-op pool can only be sized once.
+"""
+
+
+class BenchmarkOptions(TrainOptions):
+    def initialize(self, parser):
+        parser = super().initialize(parser)
+        parser.add_argument('--configs', type=str, default='0:0:0:0',
+                            help='comma separated intra_threads:interop_threads:num_threads:loader_cores')
+        parser.add_argument('--steps', type=int, default=20, help='timed training steps per config')
+        parser.add_argument('--warmup', type=int, default=3, help='untimed steps before timing')
+        return parser
+
+
+def run_config(opt, config, queue):
+    opt.intra_threads, opt.interop_threads, opt.num_threads, opt.loader_cores = config
+    worker_cores = setup_cpu(opt.intra_threads, opt.interop_threads, opt.loader_cores)
+    model = Trainer(opt)
+    model.train()
+    data_loader = create_dataloader(opt, worker_cores)
+    if opt.device_prefetch:
+        data_loader = DevicePrefetcher(data_loader, model.device)
+    batches = iter(data_loader)
+    for i in range(opt.warmup + opt.steps):
+        if i == opt.warmup:
+            start = time.perf_counter()
+        try:
+            img, crops, label = next(batches)
+        except StopIteration:
+            batches = iter(data_loader)
+            img, crops, label = next(batches)
+        model.set_input((img, crops, label))
+        model.forward()
+        model.optimize_parameters()
+    elapsed = time.perf_counter() - start
+    queue.put((torch.get_num_threads(), torch.get_num_interop_threads(), opt.steps * opt.batch_size / elapsed))
+
+
+if __name__ == "__main__":
+    opt = BenchmarkOptions().parse(print_options=False)
+    # throughput does not depend on the weights, no checkpoint is loaded
+    opt.fine_tune = False
+    configs = [tuple(int(v) for v in c.split(":")) for c in opt.configs.split(",")]
+
+    # spawn gives every config a fresh process with unset thread pools
+    ctx = mp.get_context("spawn")
+    results = []
+    for config in configs:
+        queue = ctx.Queue()
+        p = ctx.Process(target=run_config, args=(opt, config, queue))
+        p.start()
+        p.join()
+        if p.exitcode != 0:
+            raise RuntimeError(f"config {config} failed")
+        results.append((config, queue.get()))
+
+    print("{:>8} {:>8} {:>8} {:>8} {:>12}".format("intra", "interop", "workers", "l_cores", "samples/s"))
+    for (intra, interop, workers, loader_cores), (n_intra, n_interop, throughput) in results:
+        print("{:>8} {:>8} {:>8} {:>8} {:>12.2f}".format(n_intra, n_interop, workers, loader_cores, throughput))
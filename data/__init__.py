@@ -1,34 +1,16 @@
-import torch
-import numpy as np
-from torch.utils.data.sampler import WeightedRandomSampler
-from .datasets import AVLip
+import importlib
 
+# torch, the dataset and the loader code are imported on first use, so that the torch-free
+# modules (data.shards, data.index) load on their own, e.g. in the preprocessing workers
+_lazy = {
+    "AVLip": ".datasets",
+    "AVLipStream": ".datasets",
+    "create_dataloader": ".loader",
+    "DevicePrefetcher": ".loader",
+}
 
-def get_bal_sampler(dataset):
-    targets = []
-    for d in dataset.datasets:
-        targets.extend(d.targets)
 
-    ratio = np.bincount(targets)
-    w = 1.0 / torch.tensor(ratio, dtype=torch.float)
-    sample_weights = w[targets]
-    sampler = WeightedRandomSampler(
-        weights=sample_weights, num_samples=len(sample_weights)
-    )
-    return sampler
-
-
-def create_dataloader(opt):
-    shuffle = not opt.serial_batches if (opt.isTrain and not opt.class_bal) else False
-    dataset = AVLip(opt)
-
-    sampler = get_bal_sampler(dataset) if opt.class_bal else None
-
-    data_loader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=opt.batch_size,
-        shuffle=True,
-        sampler=sampler,
-        num_workers=int(opt.num_threads),
-    )
-    return data_loader
+def __getattr__(name):
+    if name in _lazy:
+        return getattr(importlib.import_module(_lazy[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,47 +1,189 @@
+import os
 import torch
+import numpy as np
 import torchvision.transforms as transforms
-from torch.utils.data import Dataset
-import glob
-from mtcnn import MTCNN
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import cv2
-from facenet_pytorch import MTCNN
+from .index import load_names
+from .shards import ShardReader, MemmapReader
+from .detection_cache import DetectionCache, file_stamp
+from .feature_cache import FeatureCache
+from .detectors import DETECTORS, build_detector
 
+# CLIP normalisation of 0-255 pixels, (x / 255 - mean) / std folded into x * SCALE - SHIFT
+MEAN = torch.tensor([0.48145466, 0.4578275, 0.40821073]).view(3, 1, 1)
+STD = torch.tensor([0.26862954, 0.26130258, 0.27577711]).view(3, 1, 1)
+SCALE = 1.0 / (255.0 * STD)
+SHIFT = MEAN / STD
+resize_crop = transforms.Resize((224, 224))
+resize_global = transforms.Resize((1120, 1120))
 
 
 class AVLip(Dataset):
     def __init__(self, opt):
         assert opt.data_label in ["train", "val"]
+        assert opt.data_format in ["png", "shard", "memmap"]
+        assert opt.detector in DETECTORS
         self.data_label = opt.data_label
-        self.real_list = glob.glob(opt.real_list_path + "/*.png")
-        self.fake_list = glob.glob(opt.fake_list_path + "/*.png")
-        self.real_list = sorted(self.real_list)
-        self.fake_list = sorted(self.fake_list)
-        self.label_dict = dict()
-        for i in self.real_list:
-            self.label_dict[i] = 0
-        for i in self.fake_list:
-            self.label_dict[i] = 1
-        self.total_list = self.real_list + self.fake_list
-        device_str = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self.detector = MTCNN(device=device_str)  # 缩进和上面一致，都是4个空格
+        self.data_format = opt.data_format
+        self.roots = [opt.real_list_path, opt.fake_list_path]
+        if self.data_format == "shard":
+            # samples packed by preprocess.py, listed under their would-be png paths
+            self.readers = [ShardReader(root) for root in self.roots]
+            self.names = [reader.names for reader in self.readers]
+        elif self.data_format == "memmap":
+            # one samples.npy per directory, packed with `python -m data.shards`
+            self.readers = [MemmapReader(root) for root in self.roots]
+            self.names = [reader.names for reader in self.readers]
+        else:
+            # sorted file names, from <root>.index.npz (`python -m data.index`) while it is up to date
+            self.names = [load_names(root) for root in self.roots]
+        self.num_real = len(self.names[0])
+        # one byte per sample, 0 real / 1 fake, what the samplers balance on
+        self.labels = np.concatenate([
+            np.zeros(len(self.names[0]), dtype=np.int8), np.ones(len(self.names[1]), dtype=np.int8)
+        ])
+        # boxes/landmarks built offline with `python -m data.detection_cache`, MTCNN only runs on a miss
+        self.detection_cache = DetectionCache(opt.detection_cache) if opt.detection_cache else None
+        self.detector_name = opt.detector
+        self._detector = None
+        # global CLIP features of a frozen conv1 + encoder, returned in place of the 1120x1120 image
+        self.feature_cache = FeatureCache(opt.feature_cache, opt.feature_key) if opt.feature_cache else None
+        self._video_ids = None
+
+    @property
+    def detector(self):
+        # built on first use, i.e. inside the DataLoader worker and only on a cache miss
+        if self._detector is None:
+            device_str = 'cuda' if torch.cuda.is_available() else 'cpu'
+            self._detector = build_detector(self.detector_name, device_str)
+        return self._detector
+
     def __len__(self):
-        return len(self.total_list)
+        return len(self.labels)
+
+    def path(self, idx):
+        r"""Path of sample ``idx``, the key of the detection and feature caches."""
+        label = int(self.labels[idx])
+        name = self.names[label][idx - self.num_real * label]
+        if isinstance(name, bytes):
+            name = name.decode()
+        return os.path.join(self.roots[label], name)
+
+    def stamp(self, idx):
+        r"""Cheap identity of the stored sample ``idx``, changes whenever the sample is written anew."""
+        if self.data_format == "shard":
+            # ShardWriter never rewrites in place, a converted-again sample lands in a new shard
+            label = int(self.labels[idx])
+            bin_path, offset, _ = self.readers[label].entries[idx - self.num_real * label]
+            return [bin_path, offset]
+        if self.data_format == "memmap":
+            label = int(self.labels[idx])
+            return file_stamp(os.path.join(self.roots[label], "samples.npy"))
+        return file_stamp(self.path(idx))
+
+    @property
+    def video_ids(self):
+        r"""int32 id of the source video of every sample, see :meth:`parse_videos`."""
+        if self._video_ids is None:
+            self._video_ids, self.groups, self.videos = self.parse_videos()
+        return self._video_ids
+
+    def parse_videos(self):
+        r"""Group the samples by the video preprocess.py cut them from, using only their names.
+
+        Samples are named ``{video}_{group}.png``; real and fake videos with the same name are
+        different videos. Returns per-sample video ids and group numbers, and the (label, video)
+        key of every id.
+        """
+        keys = dict()
+        video_ids = np.empty(len(self), dtype=np.int32)
+        groups = np.empty(len(self), dtype=np.int32)
+        for idx in range(len(self)):
+            label = int(self.labels[idx])
+            name = self.names[label][idx - self.num_real * label]
+            if isinstance(name, bytes):
+                name = name.decode()
+            video, _, group = os.path.splitext(name)[0].rpartition("_")
+            if not video or not group.isdigit():
+                # not written by preprocess.py, the sample is a video of its own
+                video, group = os.path.splitext(name)[0], "0"
+            video_ids[idx] = keys.setdefault((label, video), len(keys))
+            groups[idx] = int(group)
+        return video_ids, groups, list(keys)
+
+    @property
+    def total_list(self):
+        # built on demand, only the offline cache tools need all paths at once
+        return [self.path(i) for i in range(len(self))]
+
+    def load_image(self, idx):
+        r"""Return sample ``idx`` as an (H, W, 3) uint8 RGB array."""
+        if self.data_format in ["shard", "memmap"]:
+            label = int(self.labels[idx])
+            return self.readers[label].read(idx - self.num_real * label)
+        return cv2.cvtColor(cv2.imread(self.path(idx)), cv2.COLOR_BGR2RGB)
+
+    @staticmethod
+    def to_tensor(img):
+        # uint8 C×H×W view of the sample (zero-copy for shard/memmap), converted to float per crop
+        return torch.from_numpy(img).permute(2, 0, 1)
+
+    @staticmethod
+    def face_frames(img):
+        r"""Cut the five 500x500 video frames and resize them to 224x224 in one call, (5, 3, 224, 224)."""
+        frames = img[:, 500:, :2500].unflatten(2, (5, 500)).permute(2, 0, 1, 3)
+        return resize_crop(frames.float())
+
+    @staticmethod
+    def global_input(img):
+        r"""Resize the whole (3, H, W) uint8 sample to the normalised (3, 1120, 1120) encoder input."""
+        return resize_global(img.float()).mul_(SCALE).sub_(SHIFT)
+
+    def detect_frames(self, frames):
+        r"""Detect faces in a (N, 3, H, W) batch of frames with a single detector call.
+
+        Returns [(boxes, probs, landmarks)], one tuple per frame, in the same form as
+        detecting each frame on its own.
+        """
+        faces_np = frames.permute(0, 2, 3, 1).numpy().astype('uint8')
+        # 用 facenet_pytorch 的 MTCNN.detect 获取人脸框和关键点
+        boxes, probs, landmarks = self.detector.detect(faces_np, landmarks=True)
+        return list(zip(boxes, probs, landmarks))
+
+    def detect(self, idx, frames):
+        if self.detection_cache is not None:
+            # a png file, shard entry or samples.npy written since the cache was built is a miss
+            detections = self.detection_cache.get(self.path(idx), self.stamp(idx))
+            if detections is not None:
+                return detections
+        return self.detect_frames(frames)
+
+    def storage_order(self):
+        r"""Sample indices in the order they are stored on disk, what :class:`AVLipStream` reads in."""
+        if self.data_format == "shard":
+            # shard readers list samples by name, the files hold them in write order
+            keys = [entry[:2] for reader in self.readers for entry in reader.entries]
+            return np.array(sorted(range(len(keys)), key=keys.__getitem__), dtype=np.int64)
+        return np.arange(len(self), dtype=np.int64)
 
     def __getitem__(self, idx):
-        img_path = self.total_list[idx]
-        label = self.label_dict[img_path]
-        img = torch.tensor(cv2.cvtColor(cv2.imread(img_path), cv2.COLOR_BGR2RGB), dtype=torch.float32)
-        img = img.permute(2, 0, 1)
+        return self.process(idx, self.load_image(idx))
+
+    def process(self, idx, img):
+        r"""Sample ``idx`` as (global input, crops, label) from its (H, W, 3) uint8 array."""
+        img_path = self.path(idx)
+        label = int(self.labels[idx])
+        img = self.to_tensor(img)
         # crop images
-        crops = [[transforms.Resize((224, 224))(img[:, 500:, i * 500:(i * 500) + 500]) for i in range(5)], [], []]
+        frames = self.face_frames(img)
+        crops = [frames, [], []]
         crop_idx = [(28, 196), (61, 163)]
+        detections = self.detect(idx, crops[0])
 
         for i in range(len(crops[0])):
             face_tensor = crops[0][i]  # C×H×W tensor
-            face_np = face_tensor.permute(1, 2, 0).numpy().astype('uint8')
-
-            # 用 facenet_pytorch 的 MTCNN.detect 获取人脸框和关键点
-            boxes, probs, landmarks = self.detector.detect(face_np, landmarks=True)
+            boxes, probs, landmarks = detections[i]
 
             if boxes is not None and len(boxes) > 0:
                 # 只处理第一个检测到的人脸
@@ -69,7 +211,7 @@ class AVLip(Dataset):
                     y1 = H - side
 
                 sq_face = face_tensor[:, y1:y2, x1:x2]  # 正方形脸部区域
-                crops[1].append(transforms.Resize((224, 224))(sq_face))
+                crops[1].append(resize_crop(sq_face))
 
                 # 关键点 landmarks[0] 顺序是 左眼、右眼、鼻子、左嘴角、右嘴角
                 kps = landmarks[0]
@@ -99,26 +241,132 @@ class AVLip(Dataset):
                     my1 = H - mside
 
                 sq_mouth = face_tensor[:, my1:my2, mx1:mx2]
-                crops[2].append(transforms.Resize((224, 224))(sq_mouth))
+                crops[2].append(resize_crop(sq_mouth))
 
             else:
                 # 无检测人脸时回退到原始分块
-                crops[1].append(transforms.Resize((224, 224))
+                crops[1].append(resize_crop
                                 (crops[0][i][:, crop_idx[0][0]:crop_idx[0][1], crop_idx[0][0]:crop_idx[0][1]]))
-                crops[2].append(transforms.Resize((224, 224))
+                crops[2].append(resize_crop
                                 (crops[0][i][:, crop_idx[1][0]:crop_idx[1][1], crop_idx[1][0]:crop_idx[1][1]]))
 
-        normalize = transforms.Normalize(mean=[0.48145466, 0.4578275, 0.40821073],
-                                         std=[0.26862954, 0.26130258, 0.27577711])
-        # 归一化
-        for j in range(len(crops)):
-            for k in range(len(crops[j])):
-                crops[j][k] = crops[j][k] / 255.0
-                crops[j][k] = normalize(crops[j][k]).clone().detach()
-
-        img = img / 255.0
-        img = transforms.Resize((1120, 1120))(img)
-        img = normalize(img)
+        # 归一化: all 15 crops as one (15, 3, 224, 224) tensor, scaled and normalised in place
+        crops = torch.cat([frames, torch.stack(crops[1]), torch.stack(crops[2])])
+        crops.mul_(SCALE).sub_(SHIFT)
+        # (3 regions: head/face/mouth, 5 frames, 3, 224, 224), collated to (B, 3, 5, 3, 224, 224)
+        crops = crops.view(3, len(frames), *crops.shape[1:])
+
+        if self.feature_cache is not None:
+            img = torch.from_numpy(self.feature_cache.get(img_path, self.stamp(idx)))
+        else:
+            img = self.global_input(img)
         label = torch.tensor(label, dtype=torch.float32)
         return img, crops, label
 
+
+
+class AVLipStream(IterableDataset):
+    r"""AVLip read sequentially in storage order, for training from slow bulk storage.
+
+    Every epoch the samples of each class are cut into blocks of ``stream_block`` consecutive
+    stored samples (mostly within one shard file), the blocks are shuffled, and the real and
+    fake blocks are interleaved evenly, since storage order is class-pure. Every
+    (rank, DataLoader worker) streams its own contiguous slice of that sequence through a
+    shuffle buffer of ``shuffle_buffer`` read samples, which mixes the samples of about
+    ``shuffle_buffer / stream_block`` blocks. All of it follows from ``seed`` and the
+    epoch, so ``set_epoch(epoch, skip_batches)`` resumes an epoch after its first batches
+    without reading the samples they held.
+    """
+
+    def __init__(self, opt, num_replicas=1, rank=0):
+        self.dataset = AVLip(opt)
+        self.block = opt.stream_block
+        self.buffer_size = opt.shuffle_buffer
+        self.batch_size = opt.batch_size
+        self.seed = opt.seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        order = self.dataset.storage_order()
+        self.class_orders = [order[self.dataset.labels[order] == label] for label in [0, 1]]
+        self.num_samples = -(-len(order) // self.num_replicas)
+        self.epoch = 0
+        self.skip_batches = 0
+
+    def set_epoch(self, epoch, skip_batches=0):
+        r"""Stream ``epoch`` from its batch ``skip_batches`` on (of this rank), call before iterating."""
+        self.epoch = epoch
+        self.skip_batches = skip_batches
+
+    def __len__(self):
+        return self.num_samples
+
+    def epoch_order(self):
+        r"""Sample indices of this rank for the current epoch, before the shuffle buffer."""
+        rng = np.random.default_rng([self.seed, self.epoch])
+        blocks, positions = [], []
+        for order in self.class_orders:
+            starts = np.arange(0, len(order), self.block)
+            rng.shuffle(starts)
+            blocks.extend(order[start:start + self.block] for start in starts)
+            # the blocks of a class spread evenly over the epoch, at a random phase
+            positions.append((np.arange(len(starts)) + rng.random()) / max(len(starts), 1))
+        order = np.concatenate([blocks[i] for i in np.argsort(np.concatenate(positions), kind="stable")])
+        # padded by wrapping around, so every rank gets the same number of samples
+        order = np.resize(order, self.num_samples * self.num_replicas)
+        return order[self.rank * self.num_samples:(self.rank + 1) * self.num_samples]
+
+    def worker_split(self, num_workers):
+        r"""Slices of the epoch order of the workers of an uninterrupted epoch, as (start, stop, skip).
+
+        ``skip`` counts the samples of the slice in the first ``skip_batches`` batches. Also returns
+        the worker whose batch would come next, the DataLoader of a resumed epoch starts at worker 0.
+        """
+        bounds = [self.num_samples * w // num_workers for w in range(num_workers + 1)]
+        batches = [-(-(stop - start) // self.batch_size) for start, stop in zip(bounds, bounds[1:])]
+        # the DataLoader takes whole batches from its workers in turn, skipping exhausted ones
+        taken = [0] * num_workers
+        worker = 0
+        for _ in range(min(self.skip_batches, sum(batches))):
+            while taken[worker] == batches[worker]:
+                worker = (worker + 1) % num_workers
+            taken[worker] += 1
+            worker = (worker + 1) % num_workers
+        splits = [
+            (start, stop, min(t * self.batch_size, stop - start))
+            for start, stop, t in zip(bounds, bounds[1:], taken)
+        ]
+        return splits, worker
+
+    def read(self, idx):
+        # copied out of the file map, so that the read happens now, in storage order
+        return np.array(self.dataset.load_image(idx))
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        splits, first = self.worker_split(num_workers)
+        # worker 0 continues where the interrupted epoch stopped
+        worker_id = (worker_id + first) % num_workers
+        start, stop, skip = splits[worker_id]
+        refs = self.epoch_order()[start:stop]
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker_id])
+
+        # the buffer holds (idx, array) pairs; samples that leave it before ``skip`` are never read, the
+        # same random draws on the indices alone reproduce the order of an uninterrupted epoch
+        buffer = []
+        emitted = 0
+        refs = iter(refs.tolist())
+        while True:
+            idx = next(refs, None)
+            if idx is not None:
+                buffer.append((idx, self.read(idx) if emitted >= skip else None))
+                if len(buffer) < self.buffer_size:
+                    continue
+            elif not buffer:
+                return
+            j = rng.integers(len(buffer))
+            buffer[j], buffer[-1] = buffer[-1], buffer[j]
+            idx, img = buffer.pop()
+            emitted += 1
+            if emitted > skip:
+                yield self.dataset.process(idx, img if img is not None else self.read(idx))
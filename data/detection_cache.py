@@ -0,0 +1,127 @@
+import os
+import pickle
+import hashlib
+import argparse
+import torch
+from tqdm import tqdm
+
+
+"""
+Face detections of every sample, computed once so that AVLip does not run MTCNN each epoch.
+{
+    "version": 1,
+    "entries": {
+        <sample path>: {
+            "stamp": identity of the stored sample, see AVLip.stamp: [size, mtime_ns] of the png file,
+                     [bin_path, offset] in the shard files, [size, mtime_ns] of samples.npy for memmap,
+            "sha1": hash of the decoded uint8 sample,
+            "detections": [(boxes, probs, landmarks)] for each of the 5 face frames,
+        },
+    },
+}
+"""
+
+
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def sample_hash(img):
+    return hashlib.sha1(img.tobytes()).hexdigest()
+
+
+class DetectionCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.entries = pickle.load(f)["entries"]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, img_path, stamp):
+        r"""Cached detections of ``img_path``, or None on a miss or a sample stored anew since (``stamp`` changed)."""
+        entry = self.entries.get(img_path)
+        if entry is None or entry["stamp"] != stamp:
+            return None
+        return entry["detections"]
+
+    def put(self, img_path, stamp, sha1, detections):
+        self.entries[img_path] = {
+            "stamp": stamp,
+            "sha1": sha1,
+            "detections": detections,
+        }
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"version": 1, "entries": self.entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+
+def build_cache(dataset, cache, batch_size=8, save_freq=1000):
+    r"""Run the detector on every sample of ``dataset`` whose content is not cached yet.
+
+    The face frames of ``batch_size`` samples go through the detector in one call.
+    """
+    detected = 0
+    pending = []
+
+    def flush():
+        nonlocal detected
+        frames = torch.cat([sample_frames for _, _, _, sample_frames in pending])
+        detections = dataset.detect_frames(frames)
+        for i, (img_path, stamp, sha1, sample_frames) in enumerate(pending):
+            n = len(sample_frames)
+            cache.put(img_path, stamp, sha1, detections[i * n:(i + 1) * n])
+            detected += 1
+            if detected % save_freq == 0:
+                cache.save()
+        pending.clear()
+
+    for idx in tqdm(range(len(dataset)), desc="Detecting faces"):
+        img_path = dataset.path(idx)
+        stamp = dataset.stamp(idx)
+        img = dataset.load_image(idx)
+        sha1 = sample_hash(img)
+        entry = cache.entries.get(img_path)
+        if entry is not None and entry["sha1"] == sha1:
+            # same content, only the stamp may have moved (touched png, repacked or rewritten shard)
+            entry["stamp"] = stamp
+            continue
+        pending.append((img_path, stamp, sha1, dataset.face_frames(dataset.to_tensor(img))))
+        if len(pending) == batch_size:
+            flush()
+    if pending:
+        flush()
+    cache.save()
+    return detected
+
+
+if __name__ == "__main__":
+    from .datasets import AVLip
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--real_list_path", type=str, required=True)
+    parser.add_argument("--fake_list_path", type=str, required=True)
+    parser.add_argument("--data_format", type=str, default="png", help="png, shard or memmap")
+    parser.add_argument("--data_label", type=str, default="train")
+    parser.add_argument("--detector", type=str, default="facenet", help="facenet or mtcnn")
+    parser.add_argument("--cache", type=str, required=True, help="detection cache file to create or update")
+    parser.add_argument("--batch_size", type=int, default=8, help="samples per detector call")
+    opt = parser.parse_args()
+
+    cache = DetectionCache(opt.cache)
+    # the dataset itself must not read from the cache that is being built
+    opt.detection_cache = ""
+    opt.feature_cache = ""
+    dataset = AVLip(opt)
+    detected = build_cache(dataset, cache, opt.batch_size)
+    print(f"{detected} samples detected, {len(cache)} samples cached in {opt.cache}")
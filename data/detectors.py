@@ -0,0 +1,58 @@
+import os
+import numpy as np
+
+
+"""
+Face detector backends for AVLip. Every backend is imported only when it is built, so
+importing the dataset (and starting DataLoader workers) does not load torch-MTCNN weights
+or TensorFlow. All detectors follow facenet_pytorch's batched interface:
+detect(frames (N, H, W, 3) uint8, landmarks=True) -> (boxes, probs, landmarks), each of
+length N with None for frames without a face.
+"""
+
+DETECTORS = ["facenet", "mtcnn", "none"]
+
+
+class TFMTCNN:
+    r"""Adapter around the TensorFlow ``mtcnn`` package."""
+
+    def __init__(self):
+        os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+        from mtcnn import MTCNN
+
+        self.detector = MTCNN()
+
+    def detect(self, frames, landmarks=True):
+        boxes, probs, points = [], [], []
+        for frame in frames:
+            faces = self.detector.detect_faces(frame)
+            if not faces:
+                boxes.append(None)
+                probs.append([None])
+                points.append(None)
+                continue
+            boxes.append(np.array([[x, y, x + w, y + h] for x, y, w, h in (f["box"] for f in faces)], dtype=np.float32))
+            probs.append(np.array([f["confidence"] for f in faces], dtype=np.float32))
+            keys = ["left_eye", "right_eye", "nose", "mouth_left", "mouth_right"]
+            points.append(np.array([[f["keypoints"][k] for k in keys] for f in faces], dtype=np.float32))
+        return boxes, probs, points
+
+
+class NoDetector:
+    r"""Never finds a face, so AVLip falls back to its fixed face/mouth crops."""
+
+    def detect(self, frames, landmarks=True):
+        n = len(frames)
+        return [None] * n, [[None]] * n, [None] * n
+
+
+def build_detector(name, device="cpu"):
+    if name == "facenet":
+        from facenet_pytorch import MTCNN
+
+        return MTCNN(device=device)
+    if name == "mtcnn":
+        return TFMTCNN()
+    if name == "none":
+        return NoDetector()
+    raise ValueError(f"detector should be one of {DETECTORS}")
@@ -0,0 +1,129 @@
+import os
+import json
+import hashlib
+import torch
+import numpy as np
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+from utils import get_world_size, get_rank, barrier
+
+
+"""
+Global CLIP features of every sample, computed once for a frozen LipFD.conv1 + encoder.
+<root>
+├── <key>.npy     (N, 768) float32, row i is the feature of names[i]
+└── <key>.json    {"names": [sample paths], "stamps": [AVLip.stamp of the encoded sample]}
+<key> is a hash of the conv1 and encoder.visual weights, so a different checkpoint
+never reads the features of another one. A sample stored anew under the same path (its
+stamp changed) is encoded again into a new row, the last row of a path is its feature.
+"""
+
+
+def feature_key(model):
+    r"""Hash of the weights that produce the global feature, ``model`` is a LipFD."""
+    sha1 = hashlib.sha1()
+    for module in [model.conv1, model.encoder.visual]:
+        for name, t in module.state_dict().items():
+            sha1.update(name.encode())
+            sha1.update(t.detach().cpu().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return sha1.hexdigest()[:16]
+
+
+class FeatureCache:
+    def __init__(self, root, key):
+        self.prefix = os.path.join(root, key)
+        self.names = []
+        self.stamps = []
+        self.rows = dict()
+        self.features = None
+        if os.path.exists(self.prefix + ".json"):
+            with open(self.prefix + ".json") as f:
+                index = json.load(f)
+            self.names = index["names"]
+            # caches written before stamps were recorded match no sample and are encoded again
+            self.stamps = index.get("stamps", [None] * len(self.names))
+            self.rows = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def fresh(self, path, stamp):
+        r"""Whether the cache holds the feature of ``path`` as stored with ``stamp``."""
+        return path in self.rows and self.stamps[self.rows[path]] == stamp
+
+    def get(self, path, stamp):
+        r"""Return the (768,) float32 feature of ``path`` as a view into the cache file."""
+        if not self.fresh(path, stamp):
+            raise KeyError(f"{path} is not in the feature cache or was stored anew since, rebuild the cache")
+        # opened lazily so that every DataLoader worker maps the file itself
+        if self.features is None:
+            self.features = np.load(self.prefix + ".npy", mmap_mode="c")
+        return self.features[self.rows[path]]
+
+    def add(self, paths, stamps, features):
+        r"""Append ``features`` (len(paths), 768) and rewrite the cache files."""
+        names = self.names + list(paths)
+        stamps = self.stamps + list(stamps)
+        old = np.load(self.prefix + ".npy", mmap_mode="r") if self.rows else None
+        os.makedirs(os.path.dirname(self.prefix) or ".", exist_ok=True)
+        tmp_path = self.prefix + ".tmp.npy"
+        out = open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(names), features.shape[1]))
+        if old is not None:
+            out[:len(old)] = old
+        out[len(names) - len(paths):] = features
+        out.flush()
+        del out, old
+        # rows only ever get appended, so the old names stay valid until the new ones are written
+        os.replace(tmp_path, self.prefix + ".npy")
+        with open(self.prefix + ".json.tmp", "w") as f:
+            json.dump({"names": names, "stamps": stamps}, f)
+        os.replace(self.prefix + ".json.tmp", self.prefix + ".json")
+        self.names = names
+        self.stamps = stamps
+        self.rows = {name: i for i, name in enumerate(names)}
+        self.features = None
+
+
+def build_feature_cache(model, dataset, cache, device, batch_size=16):
+    r"""Encode every sample of ``dataset`` that ``cache`` does not hold (as stored now), returns the number encoded.
+
+    Under torchrun every rank calls it: each encodes its share of the samples into
+    <key>.part<rank>.npy and rank 0 merges the parts into the cache.
+    """
+    paths, stamps, indices = [], [], []
+    for idx in range(len(dataset)):
+        path, stamp = dataset.path(idx), dataset.stamp(idx)
+        if not cache.fresh(path, stamp):
+            paths.append(path)
+            stamps.append(stamp)
+            indices.append(idx)
+    if not paths:
+        return 0
+    world_size, rank = get_world_size(), get_rank()
+    share = indices[rank::world_size]
+    features = [np.zeros((0, 768), dtype=np.float32)]
+    with torch.no_grad():
+        for start in tqdm(range(0, len(share), batch_size), desc="Caching global features", disable=rank != 0):
+            img = torch.stack([
+                dataset.global_input(dataset.to_tensor(dataset.load_image(idx)))
+                for idx in share[start:start + batch_size]
+            ])
+            features.append(model.get_features(img.to(device)).float().cpu().numpy())
+    features = np.concatenate(features)
+    if world_size == 1:
+        cache.add(paths, stamps, features)
+        return len(paths)
+
+    part_path = lambda r: f"{cache.prefix}.part{r}.npy"
+    os.makedirs(os.path.dirname(cache.prefix) or ".", exist_ok=True)
+    np.save(part_path(rank), features)
+    barrier()
+    if rank == 0:
+        # the parts hold samples r, r + world_size, ... of the missing ones
+        order = [i for r in range(world_size) for i in range(r, len(paths), world_size)]
+        parts = [np.load(part_path(r)) for r in range(world_size)]
+        cache.add([paths[i] for i in order], [stamps[i] for i in order], np.concatenate(parts))
+        for r in range(world_size):
+            os.remove(part_path(r))
+    barrier()
+    return len(paths)
@@ -0,0 +1,50 @@
+import os
+import glob
+import argparse
+import numpy as np
+
+
+"""
+Cached listing of a png sample directory, so that AVLip does not glob millions of files:
+<root>.index.npz    next to the directory, writing it does not touch the directory mtime
+├── names           sorted file names as a fixed-width bytes array
+└── mtime           st_mtime_ns of <root> when listed, any added/removed/renamed file changes it
+Build or refresh with `python -m data.index <root> ...`.
+"""
+
+
+def index_path(root):
+    return os.path.normpath(root) + ".index.npz"
+
+
+def list_names(root):
+    return sorted(os.path.basename(p) for p in glob.glob(os.path.join(root, "*.png")))
+
+
+def build_index(root):
+    # stat before listing, a file added while globbing leaves the index stale instead of wrong
+    mtime = os.stat(root).st_mtime_ns
+    names = np.array([name.encode() for name in list_names(root)], dtype=bytes)
+    tmp_path = index_path(root) + ".tmp.npz"
+    np.savez(tmp_path, names=names, mtime=np.int64(mtime))
+    os.replace(tmp_path, index_path(root))
+    return len(names)
+
+
+def load_names(root):
+    r"""Sorted png file names of ``root``, from the index when it is up to date, else by globbing."""
+    try:
+        with np.load(index_path(root)) as index:
+            if int(index["mtime"]) == os.stat(root).st_mtime_ns:
+                return index["names"]
+    except (OSError, KeyError, ValueError):
+        pass
+    return np.array([name.encode() for name in list_names(root)], dtype=bytes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("roots", nargs="+", help="sample directories, e.g. .../0_real .../1_fake")
+    opt = parser.parse_args()
+    for root in opt.roots:
+        print(f"{root}: indexed {build_index(root)} samples into {index_path(root)}")
@@ -0,0 +1,88 @@
+import torch
+from functools import partial
+from torch.utils.data.distributed import DistributedSampler
+from utils import get_world_size, get_rank, pin_worker
+from .datasets import AVLip, AVLipStream
+from .samplers import ClassBalancedSampler, VideoGroupSampler
+
+
+def create_dataloader(opt, worker_cores=None):
+    shuffle = not opt.serial_batches if (opt.isTrain and not opt.class_bal) else False
+    stream = opt.isTrain and opt.stream
+    if stream and (opt.class_bal or opt.groups_per_video > 0):
+        raise ValueError("--stream decides the sample order itself, it can not be combined with --class_bal or --groups_per_video")
+    if opt.isTrain and opt.class_bal and opt.groups_per_video > 0:
+        raise ValueError("--groups_per_video and --class_bal both decide the sample order, use only one of them")
+    if stream:
+        dataset = AVLipStream(opt, num_replicas=get_world_size(), rank=get_rank())
+        shuffle = False
+    else:
+        dataset = AVLip(opt)
+
+    sampler = None
+    if opt.isTrain and opt.groups_per_video > 0:
+        sampler = VideoGroupSampler(
+            dataset.video_ids, opt.groups_per_video, num_replicas=get_world_size(), rank=get_rank(), seed=opt.seed
+        )
+    elif opt.isTrain and opt.class_bal:
+        sampler = ClassBalancedSampler(dataset.labels, num_replicas=get_world_size(), rank=get_rank(), seed=opt.seed)
+    elif get_world_size() > 1 and not stream:
+        if opt.isTrain:
+            sampler = DistributedSampler(dataset, shuffle=shuffle, seed=opt.seed)
+        else:
+            # every validation sample exactly once across the ranks, validate() gathers the results
+            sampler = range(get_rank(), len(dataset), get_world_size())
+
+    num_workers = int(opt.num_threads)
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=opt.batch_size,
+        # a sampler decides the order itself, DataLoader refuses shuffle=True next to one
+        shuffle=shuffle if sampler is None else False,
+        sampler=sampler,
+        num_workers=num_workers,
+        worker_init_fn=partial(pin_worker, worker_cores) if worker_cores else None,
+        pin_memory=opt.pin_memory,
+        # workers (and their detector, caches and file maps) survive across epochs; a stream is
+        # copied into its workers and would miss set_epoch, its workers start anew every epoch
+        persistent_workers=opt.persistent_workers and num_workers > 0 and not stream,
+        prefetch_factor=opt.prefetch_factor if num_workers > 0 else None,
+    )
+    return data_loader
+
+
+class DevicePrefetcher:
+    r"""Iterate over ``loader`` with every batch already on ``device``.
+
+    On cuda the copy of the next batch is issued on a side stream while the current step runs,
+    which only overlaps with pin_memory=True. Elsewhere batches are passed through unchanged.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.sampler = loader.sampler
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        with torch.cuda.stream(self.stream):
+            return [t.to(self.device, non_blocking=True) for t in batch]
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from self.loader
+            return
+        batches = iter(self.loader)
+        next_batch = self._to_device(next(batches, []))
+        while next_batch:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            batch = next_batch
+            for t in batch:
+                # the memory was allocated on the side stream but is used on the current one
+                t.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self._to_device(next(batches, []))
+            yield batch
@@ -0,0 +1,81 @@
+import math
+import numpy as np
+from torch.utils.data.sampler import Sampler
+
+
+class ClassBalancedSampler(Sampler):
+    r"""Draw every class equally often, from a compact array of per-sample labels.
+
+    An epoch has ``num_samples`` indices (default: the dataset size), split evenly between the
+    classes. Within a class, indices are drawn without replacement from a fresh permutation,
+    and a class with fewer samples than its share is cycled through several permutations.
+    The order only depends on ``seed`` and the epoch set with :meth:`set_epoch`, so all ranks
+    draw the same order and each keeps every ``num_replicas``-th index.
+    """
+
+    def __init__(self, labels, num_samples=None, num_replicas=1, rank=0, seed=0):
+        labels = np.asarray(labels)
+        dtype = np.int32 if len(labels) < 2 ** 31 else np.int64
+        self.class_indices = [np.flatnonzero(labels == c).astype(dtype) for c in np.unique(labels)]
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        # samples of this rank, padded so that every rank gets the same number
+        self.num_samples = math.ceil((num_samples or len(labels)) / num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        total = self.num_samples * self.num_replicas
+        per_class = math.ceil(total / len(self.class_indices))
+        draws = []
+        for indices in self.class_indices:
+            cycles = math.ceil(per_class / len(indices))
+            draws.append(np.concatenate([rng.permutation(indices) for _ in range(cycles)])[:per_class])
+        order = np.concatenate(draws)
+        rng.shuffle(order)
+        # lazily, one python int at a time instead of a list of the whole epoch
+        return (int(i) for i in order[:total][self.rank::self.num_replicas])
+
+    def __len__(self):
+        return self.num_samples
+
+
+class VideoGroupSampler(Sampler):
+    r"""Draw at most ``groups_per_video`` samples (groups) of every video per epoch.
+
+    Long videos no longer outweigh short ones and an epoch shrinks to about
+    ``groups_per_video`` samples per video. Which groups are drawn changes with
+    :meth:`set_epoch`; seeding and the split across ranks work as in :class:`ClassBalancedSampler`.
+    """
+
+    def __init__(self, video_ids, groups_per_video, num_replicas=1, rank=0, seed=0):
+        self.video_ids = np.asarray(video_ids)
+        self.groups_per_video = groups_per_video
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        counts = np.bincount(self.video_ids)
+        self.num_samples = math.ceil(int(np.minimum(counts, groups_per_video).sum()) / num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        # samples sorted by video and randomly within each video, keep the first groups_per_video of each
+        order = np.lexsort((rng.random(len(self.video_ids)), self.video_ids))
+        sorted_ids = self.video_ids[order]
+        first = np.searchsorted(sorted_ids, sorted_ids, side="left")
+        chosen = order[np.arange(len(order)) - first < self.groups_per_video]
+        rng.shuffle(chosen)
+        total = self.num_samples * self.num_replicas
+        chosen = np.resize(chosen, total)  # pads by repeating the first samples
+        return (int(i) for i in chosen[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return self.num_samples
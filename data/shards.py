@@ -0,0 +1,190 @@
+import os
+import cv2
+import glob
+import json
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+"""
+Packed sample format written by preprocess.py (OUTPUT_FORMAT = "shard"):
+<root>
+├── shard_00000.idx              index of one preprocessing run (ShardWriter), one json line per
+│                                sample {"name", "bin", "offset", "shape"} or removal {"name", "deleted"}
+├── shard_00000_<pid>_00000.bin  raw uint8 samples stored back to back by one worker (ShardBinWriter)
+├── shard_00000_<pid>_00001.bin
+└── shard_00001.idx              the next run, its entries replace those of earlier runs
+A sample is the same (H, W, 3) RGB array that would have been saved as <root>/<name>.
+Index lines without "bin" (older directories) refer to the shard_XXXXX.bin next to the index.
+
+Memory-mapped format (python -m data.shards <root>):
+<root>
+├── samples.npy        all samples of the directory as one (N, H, W, 3) uint8 array
+└── samples.json       {"names": [...]}, row i of samples.npy is names[i]
+"""
+
+
+class ShardWriter:
+    r"""Index of one preprocessing run, the sample data is written by :class:`ShardBinWriter`."""
+
+    def __init__(self, root):
+        self.root = root
+        # never append to the index of an earlier run, start after the last one
+        self.prefix = "shard_%05d" % len(glob.glob(os.path.join(root, "shard_*.idx")))
+        self.idx_file = None
+
+    def _index(self, entry):
+        if self.idx_file is None:
+            self.idx_file = open(os.path.join(self.root, self.prefix + ".idx"), "w")
+        self.idx_file.write(json.dumps(entry) + "\n")
+        self.idx_file.flush()
+
+    def index(self, entries):
+        r"""Index samples written by a :class:`ShardBinWriter`, after their data."""
+        for entry in entries:
+            self._index(entry)
+
+    def delete(self, name):
+        r"""Mark a sample of an earlier run as removed."""
+        self._index({"name": name, "deleted": True})
+
+    def close(self):
+        if self.idx_file is not None:
+            self.idx_file.close()
+            self.idx_file = None
+
+
+class ShardBinWriter:
+    r"""Sample data written by one process, indexed by the :class:`ShardWriter` of another.
+
+    Writes <root>/<prefix>_00000.bin, <prefix>_00001.bin, ... and returns the index entry of
+    every sample; ``prefix`` must be unique to the process, e.g. the indexing writer's
+    prefix plus the pid.
+    """
+
+    def __init__(self, root, prefix, shard_size=1 << 30):
+        self.root = root
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shard_id = 0
+        self.bin_file = None
+        self.bin_name = None
+        self.offset = 0
+
+    def write(self, name, array):
+        if self.bin_file is None or self.offset >= self.shard_size:
+            self.close()
+            self.bin_name = "%s_%05d.bin" % (self.prefix, self.shard_id)
+            self.bin_file = open(os.path.join(self.root, self.bin_name), "wb")
+            self.shard_id += 1
+            self.offset = 0
+        array = np.ascontiguousarray(array, dtype=np.uint8)
+        self.bin_file.write(array.tobytes())
+        # on disk before its index entry is handed out, even if the process is killed later
+        self.bin_file.flush()
+        entry = {"name": name, "bin": self.bin_name, "offset": self.offset, "shape": list(array.shape)}
+        self.offset += array.nbytes
+        return entry
+
+    def close(self):
+        if self.bin_file is not None:
+            self.bin_file.close()
+            self.bin_file = None
+
+
+class ShardReader:
+    def __init__(self, root):
+        self.root = root
+        entries = dict()
+        # shards are replayed in write order, so a rewritten sample keeps its latest version
+        for idx_path in sorted(glob.glob(os.path.join(root, "shard_*.idx"))):
+            shard_bin_path = idx_path[:-len(".idx")] + ".bin"
+            with open(idx_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("deleted"):
+                        entries.pop(entry["name"], None)
+                        continue
+                    bin_path = os.path.join(root, entry["bin"]) if "bin" in entry else shard_bin_path
+                    entries[entry["name"]] = (bin_path, entry["offset"], tuple(entry["shape"]))
+        self.names = sorted(entries)
+        self.entries = [entries[name] for name in self.names]
+        self.maps = dict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def read(self, i):
+        r"""Return sample ``i`` as an (H, W, 3) uint8 view into the shard file."""
+        bin_path, offset, shape = self.entries[i]
+        # opened lazily so that every DataLoader worker maps the files itself;
+        # copy-on-write keeps the views writable for torch.from_numpy without touching the file
+        if bin_path not in self.maps:
+            self.maps[bin_path] = np.memmap(bin_path, dtype=np.uint8, mode="c")
+        count = int(np.prod(shape))
+        return self.maps[bin_path][offset:offset + count].reshape(shape)
+
+
+class MemmapReader:
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, "samples.json")) as f:
+            self.names = json.load(f)["names"]
+        self.samples = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def read(self, i):
+        r"""Return sample ``i`` as an (H, W, 3) uint8 view into samples.npy."""
+        if self.samples is None:
+            self.samples = np.load(os.path.join(self.root, "samples.npy"), mmap_mode="c")
+        return self.samples[i]
+
+
+def pack_memmap(root, data_format="png"):
+    r"""Pack every sample under ``root`` into root/samples.npy and root/samples.json.
+
+    All samples must have the same shape, which holds for the output of preprocess.py.
+    """
+    if data_format == "shard":
+        reader = ShardReader(root)
+        names = reader.names
+        read = reader.read
+    else:
+        paths = sorted(glob.glob(os.path.join(root, "*.png")))
+        names = [os.path.basename(p) for p in paths]
+        read = lambda i: cv2.cvtColor(cv2.imread(paths[i]), cv2.COLOR_BGR2RGB)
+    if not names:
+        raise ValueError(f"no samples found in {root}")
+
+    index_path = os.path.join(root, "samples.json")
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    first = read(0)
+    samples = open_memmap(
+        os.path.join(root, "samples.npy"), mode="w+", dtype=np.uint8, shape=(len(names),) + first.shape
+    )
+    for i in range(len(names)):
+        sample = first if i == 0 else read(i)
+        if sample.shape != first.shape:
+            raise ValueError(f"{names[i]} has shape {sample.shape}, expected {first.shape}")
+        samples[i] = sample
+    samples.flush()
+    # names are written last, a directory with samples.json always has a complete array
+    with open(index_path, "w") as f:
+        json.dump({"names": names}, f)
+    return len(names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("roots", nargs="+", help="sample directories, e.g. .../0_real .../1_fake")
+    parser.add_argument("--data_format", type=str, default="png", help="format of the samples to pack, png or shard")
+    opt = parser.parse_args()
+    for root in opt.roots:
+        print(f"{root}: packed {pack_memmap(root, opt.data_format)} samples")
@@ -12,12 +12,20 @@ class LipFD(nn.Module):
         self.conv1 = nn.Conv2d(
             3, 3, kernel_size=5, stride=5
         )  # (1120, 1120) -> (224, 224)
-        self.encoder, self.preprocess = clip.load(name, device="cuda")
+        self.encoder, self.preprocess = clip.load(name, device="cuda" if torch.cuda.is_available() else "cpu")
         self.backbone = get_backbone()
 
     def forward(self, x, feature):
+        # feature: global features (batch_size, 768), or the (batch_size, 3, 1120, 1120) images to encode,
+        # so that a DistributedDataParallel wrapper also covers conv1 and the encoder
+        if feature.dim() == 4:
+            feature = self.get_features(feature)
         return self.backbone(x, feature)
 
+    def set_grad_checkpointing(self, enable=True):
+        self.backbone.grad_ckpt = enable
+        self.encoder.visual.transformer.grad_ckpt = enable
+
     def get_features(self, x):
         x = self.conv1(x)
         features = self.encoder.encode_image(x)
@@ -5,6 +5,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 
 class Bottleneck(nn.Module):
@@ -198,11 +199,16 @@ class Transformer(nn.Module):
         self.width = width
         self.layers = layers
         self.resblocks = nn.Sequential(*[ResidualAttentionBlock(width, heads, attn_mask) for _ in range(layers)])
+        # recompute the activations of every block in backward instead of storing them
+        self.grad_ckpt = False
 
     def forward(self, x: torch.Tensor):
         out = {}
         for idx, layer in enumerate(self.resblocks.children()):
-            x = layer(x)
+            if self.grad_ckpt and torch.is_grad_enabled():
+                x = checkpoint(layer, x, use_reentrant=False)
+            else:
+                x = layer(x)
             out['layer'+str(idx)] = x[0] # shape:LND. choose cls token feature   
         return out, x 
 
@@ -3,6 +3,9 @@ from torch import Tensor
 import torch.nn as nn
 from typing import Type, Any, Callable, Union, List, Optional
 from torch.nn.functional import softmax
+from torch.utils.checkpoint import checkpoint
+from contextlib import contextmanager, nullcontext
+from functools import partial
 import math
 from torch.nn import TransformerEncoder, TransformerEncoderLayer
 
@@ -226,6 +229,30 @@ class Bottleneck(nn.Module):
         return out
 
 
+@contextmanager
+def keep_bn_stats(module):
+    r"""Restore the BatchNorm running statistics of ``module`` on exit.
+
+    Wraps the recomputation of a checkpointed segment, whose second train-mode forward would
+    otherwise update running_mean/running_var/num_batches_tracked a second time.
+    """
+    buffers = [
+        b for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) for b in m.buffers()
+    ]
+    saved = [b.clone() for b in buffers]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for b, v in zip(buffers, saved):
+                b.copy_(v)
+
+
+def _checkpoint_contexts(module):
+    # (forward, recompute) contexts of torch.utils.checkpoint
+    return nullcontext(), keep_bn_stats(module)
+
+
 class ResNet(nn.Module):
 
     def __init__(
@@ -277,6 +304,12 @@ class ResNet(nn.Module):
         self.layer4 = self._make_layer(block, 512, layers[3], stride=2,
                                        dilate=replace_stride_with_dilation[2])
         self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
+        # run the trunk once on all regions and frames (B*15 images) instead of 15 times on B images,
+        # and LipCNN once on all B*5 frame differences; identical outputs in eval mode,
+        # in train mode BatchNorm sees the crops of all frames as one batch
+        self.fold_batch = False
+        # recompute the activations of layer1..layer4 in backward instead of storing them
+        self.grad_ckpt = False
 
         self.get_weight = nn.Sequential(
             nn.Linear(512 * block.expansion + 768, 1),  # TODO: 768 is the length of global feature
@@ -343,6 +376,65 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def _trunk(self, f):
+        f = self.conv1(f)
+        f = self.bn1(f)
+        f = self.relu(f)
+        f = self.maxpool(f)
+        for layer in [self.layer1, self.layer2, self.layer3, self.layer4]:
+            if self.grad_ckpt and torch.is_grad_enabled():
+                f = checkpoint(layer, f, use_reentrant=False, context_fn=partial(_checkpoint_contexts, layer))
+            else:
+                f = layer(f)
+        f = self.avgpool(f)
+        return torch.flatten(f, 1)
+
+    def _lip_folded(self, mouth):
+        r"""LSTM input (batch_size, frames, 128) from (frames, batch_size, 3, 224, 224) mouth crops.
+
+        Frame differences wrap around like the per-frame loop, frame 0 is diffed with the last frame.
+        """
+        T, B = mouth.shape[:2]
+        diffs = mouth - mouth.roll(1, dims=0)
+        f = self.lip_cnn(diffs.reshape(T * B, *mouth.shape[2:]))  # 使用CNN处理帧差
+        return f.view(T, B, -1).transpose(0, 1)
+
+    def embed(self, x):
+        r"""Pooled region features (regions, frames, batch_size, 2048) and lip features (batch_size, 256).
+
+        Everything of the forward pass that does not depend on the global feature, see :meth:`head`.
+        """
+        if torch.is_tensor(x):
+            # (batch_size, 3 regions, 5 frames, 3, 224, 224) -> (regions, frames, batch_size, 3, 224, 224)
+            x = x.permute(1, 2, 0, 3, 4, 5)
+        else:
+            x = torch.stack([torch.stack(region) for region in x])
+        R, T, B = x.shape[:3]
+        if self.fold_batch:
+            regions = self._trunk(x.reshape(R * T * B, *x.shape[3:])).view(R, T, B, -1)
+            rnn_input = self._lip_folded(x[2])
+        else:
+            regions = torch.stack([torch.stack([self._trunk(f) for f in region]) for region in x])
+            rnn_input = torch.stack([self.lip_cnn(x[2][i] - x[2][i - 1]) for i in range(T)], dim=1)
+        rnn_out, _ = self.rnn(rnn_input)
+        return regions, rnn_out[:, -1, :]
+
+    def head(self, regions, lip, feature):
+        r"""Region-aware weighting and classifier on top of :meth:`embed`.
+
+        Returns the same (pred_score, weights_max, weights_org) as the forward pass, with
+        weights_max/weights_org one (batch_size, 1) tensor per frame.
+        """
+        R, T, B = regions.shape[:3]
+        # concat regional feature with global feature
+        features = torch.cat([regions, feature.expand(R, T, B, feature.shape[-1])], dim=3)  # (R, T, B, 2816)
+        weights = softmax(self.get_weight(features), dim=0)  # (R, T, B, 1), softmax over regions
+        parts = features.mul(weights).sum(0).div(weights.sum(0))  # (T, B, 2816)
+        weights_max = list(weights.max(dim=0)[0].unbind(0))
+        weights_org = list(weights[0].unbind(0))
+        out = self.norm2(parts.sum(0).div(parts.shape[0]))
+        out = torch.cat([self.norm1(lip), out], dim=1)
+        return self.fc(out), weights_max, weights_org
 
     def _forward_impl(self, x, feature):
         def standardize(tensor):
@@ -351,6 +443,11 @@ class ResNet(nn.Module):
             return (tensor - mean) / std
         # The comment resolution is based on input size is 224*224 imagenet
         # f.shape: (batch_size, 3, 224, 224), feature.shape: (batch_size, 768)
+        if self.fold_batch:
+            return self.head(*self.embed(x), feature)
+        if torch.is_tensor(x):
+            # (batch_size, 3 regions, 5 frames, 3, 224, 224) -> (regions, frames, batch_size, 3, 224, 224)
+            x = x.permute(1, 2, 0, 3, 4, 5)
         features, weights, parts, weights_org, weights_max = [list() for i in range(5)]
         lip_features = []
         for i in range(0, len(x[2])):
@@ -368,17 +465,7 @@ class ResNet(nn.Module):
             weights.clear()
             for j in range(len(x)):
                 #头、面、嘴
-                f = x[j][i]
-                f = self.conv1(f)
-                f = self.bn1(f)
-                f = self.relu(f)
-                f = self.maxpool(f)
-                f = self.layer1(f)
-                f = self.layer2(f)
-                f = self.layer3(f)
-                f = self.layer4(f)
-                f = self.avgpool(f)
-                f = torch.flatten(f, 1)
+                f = self._trunk(x[j][i])
 
                 # features.append(f)
 
@@ -439,10 +526,18 @@ def get_backbone(pretrained: bool = False, progress: bool = True, **kwargs: Any)
 
 if __name__ == '__main__':
     model = get_backbone()
-    data = [[] for i in range(3)]
-    for i in range(3):
-        for j in range(5):
-            data[i].append(torch.rand((10, 3, 224, 224)))
+    data = torch.rand((10, 3, 5, 3, 224, 224))
     feature = torch.rand((10, 768))
     pred_score, weights_max, weights_org = model(data, feature)
-    pass
+
+    # a train step with --grad_ckpt leaves the same gradients and BatchNorm statistics as one without
+    states, grads = [], []
+    for grad_ckpt in [False, True]:
+        torch.manual_seed(0)
+        model = get_backbone().train()
+        model.grad_ckpt = grad_ckpt
+        model(data[:2], feature[:2])[0].sum().backward()
+        states.append(model.state_dict())
+        grads.append([p.grad for p in model.parameters()])
+    assert all(torch.equal(states[0][k], states[1][k]) for k in states[0])
+    assert all((g0 is None and g1 is None) or torch.allclose(g0, g1) for g0, g1 in zip(*grads))
@@ -12,15 +12,30 @@ class BaseOptions:
         parser.add_argument("--arch", type=str, default="CLIP:ViT-L/14", help="see models/__init__.py")
         parser.add_argument("--fix_backbone", default=False)
         parser.add_argument("--fix_encoder", default=True)
+        parser.add_argument("--fix_stem", action="store_true", help="also freeze LipFD.conv1, required by --feature_cache")
+        parser.add_argument("--feature_cache", type=str, default="", help="directory of cached global CLIP features, empty to run the encoder every step")
         # parser.add_argument("--real_list_path", default="./datasets/AVLips/0_real")  #注意这个是val路径，训练要改
         # parser.add_argument("--fake_list_path", default="./datasets/AVLips/1_fake")  #注意这个是val路径，训练要改
         parser.add_argument("--real_list_path", default="/root/autodl-tmp/AVLips_036/0_real")
         parser.add_argument("--fake_list_path", default="/root/autodl-tmp/AVLips_036/1_fake")
         parser.add_argument("--data_label", default="train", help="label to decide whether train or validation dataset")
+        parser.add_argument("--data_format", type=str, default="png", help="png: one image per sample, shard: packed shards written by preprocess.py, memmap: samples.npy packed by data/shards.py")
+        parser.add_argument("--detector", type=str, default="facenet", help="face detector used on a detection cache miss: facenet, mtcnn (TensorFlow) or none (fixed crops)")
+        parser.add_argument("--detection_cache", type=str, default="", help="face detection cache built by `python -m data.detection_cache`, empty to always run MTCNN")
         parser.add_argument("--batch_size", type=int, default=5, help="input batch size")
+        parser.add_argument("--precision", type=str, default="fp32", help="fp32, fp16 (cuda only, with gradient scaling) or bf16 autocast")
+        parser.add_argument("--fold_batch", action="store_true", help="run the region backbone and LipCNN once over all regions and frames; in training BatchNorm then normalises over all frames together")
+        parser.add_argument("--dist_backend", type=str, default="", help="process group backend under torchrun, default nccl on cuda and gloo on cpu")
         parser.add_argument("--gpu_ids", type=str, default="0", help="gpu ids: e.g. 0  0,1,2, 0,2. use -1 for CPU")
         parser.add_argument("--name", type=str, default="experiment_name", help="name of the experiment. It decides where to store samples and models")
         parser.add_argument("--num_threads", default=0, type=int, help="# threads for loading data")
+        parser.add_argument("--intra_threads", default=0, type=int, help="threads of every torch op on the cpu, 0 keeps the PyTorch default")
+        parser.add_argument("--interop_threads", default=0, type=int, help="threads running independent torch ops in parallel, 0 keeps the PyTorch default")
+        parser.add_argument("--loader_cores", default=0, type=int, help="pin the DataLoader workers to this many cpu cores and the training process (and its intra-op threads) to the others, per process of the node under torchrun; 0 to not pin")
+        parser.add_argument("--pin_memory", action="store_true", help="collate batches into pinned memory for faster host-to-device copies")
+        parser.add_argument("--persistent_workers", action="store_true", help="keep the DataLoader workers alive between epochs")
+        parser.add_argument("--prefetch_factor", default=2, type=int, help="batches loaded in advance by each DataLoader worker")
+        parser.add_argument("--device_prefetch", action="store_true", help="copy the next batch to the device while the current step runs (cuda, use with --pin_memory)")
         parser.add_argument("--checkpoints_dir", type=str, default="/root/autodl-tmp/checkpoints", help="models are saved here")
         parser.add_argument("--serial_batches", action="store_true", help="if true, takes images in order to make batches, otherwise takes them randomly")
         parser.add_argument("--suffix", type=str, default="", help="suffix for experiment name")
@@ -31,6 +46,9 @@ class BaseOptions:
         parser.add_argument("--jpg_qual", type=str, default="", help="jpg_qual information")
         parser.add_argument('--weight_decay', type=float, default=1e-4, help='Weight decay for optimizer')
         parser.add_argument('--class_bal',default=False, action='store_true', help='Whether to use class balancing')
+        parser.add_argument('--groups_per_video', type=int, default=0, help='train on at most this many groups of every video per epoch, 0 uses all samples')
+        parser.add_argument('--video_eval', action='store_true', help='also report validation metrics on the mean clip score of every video')
+        parser.add_argument('--seed', type=int, default=0, help='seed of the class-balanced and distributed samplers, reshuffled every epoch')
         self.initialized = True
         return parser
 
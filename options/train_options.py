@@ -17,6 +17,21 @@ class TrainOptions(BaseOptions):
         parser.add_argument('--epoch', type=int, default=4, help='total epoches')
         parser.add_argument('--beta1', type=float, default=0.9, help='momentum term of adam')
         parser.add_argument('--lr', type=float, default=3e-5, help='initial learning rate for adam')
+        parser.add_argument('--grad_ckpt', action='store_true',
+                            help='activation checkpointing of the region ResNet layers and the CLIP ViT blocks')
+        parser.add_argument('--accum_steps', type=int, default=1,
+                            help='micro-batches of --batch_size whose gradients are accumulated per optimizer step')
+        parser.add_argument('--stream', action='store_true',
+                            help='read the training samples sequentially in storage order through a shuffle buffer (AVLipStream)')
+        parser.add_argument('--stream_block', type=int, default=4,
+                            help='consecutive stored samples (one class, mostly one video) read together by a stream; '
+                                 'larger blocks read more sequentially, smaller ones mix more videos per batch')
+        parser.add_argument('--shuffle_buffer', type=int, default=32,
+                            help='samples held by every DataLoader worker of a stream to shuffle them, it mixes about '
+                                 'shuffle_buffer / stream_block blocks of alternating class; each held sample is a '
+                                 'raw uint8 frame strip (~7.5 MB), so memory grows with it times --num_threads')
+        parser.add_argument('--skip_batches', type=int, default=0,
+                            help='batches of the first epoch already trained on, resumes a stream mid-epoch')
         parser.add_argument('--pretrained_model', type=str, default="/root/autodl-tmp/checkpoints/experiment_name/ff_lip_model_epoch_2.pth", help='model will fine tune on it if fine-tune is True')
         parser.add_argument('--fine-tune', type=bool, default=True)
         self.isTrain = True
@@ -191,11 +191,17 @@
 #
 import os
 import cv2
+import json
+import hashlib
 import numpy as np
 import librosa
 import matplotlib.pyplot as plt
+from matplotlib import cm
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from tqdm import tqdm
 from librosa import feature as audio
+from data.shards import ShardWriter, ShardBinWriter
 
 
 """
@@ -212,6 +218,11 @@ AVLips
 N_EXTRACT = 10   # number of extracted images from video
 WINDOW_LEN = 5   # frames of each window
 MAX_SAMPLE = 100
+NUM_WORKERS = os.cpu_count()   # number of preprocessing processes, 1 to run serially
+SEEK_GAP = 64    # seek instead of grabbing when the next selected frame is further away, 0 to never seek
+RESUME = True    # skip videos the manifest already records as converted with the same parameters
+OUTPUT_FORMAT = "png"   # "png": one image per sample, "shard": packed uint8 shards (see data/shards.py)
+SHARD_SIZE = 1 << 30    # bytes per shard file
 
 audio_root = "/home/china/zimo_yu/LipFD-main/AVLips/wav"
 video_root = "/home/china/zimo_yu/LipFD-main/AVLips"
@@ -219,98 +230,329 @@ output_root = "/home/china/zimo_yu/LipFD-main/datasets/AVLips_1g"
 ############################################
 
 labels = [(0, "0_real"), (1, "1_fake")]
+manifest_name = "manifest.jsonl"   # one json record per converted video, kept in output_root
 
 def get_spectrogram(audio_file):
     data, sr = librosa.load(audio_file)
     mel = librosa.power_to_db(audio.melspectrogram(y=data, sr=sr), ref=np.min)
-    plt.imsave("./temp/mel.png", mel)
+    return colorize(mel)
 
 
-def run():
-    i = 0
-    for label, dataset_name in labels:
-        if not os.path.exists(dataset_name):
-            os.makedirs(f"{output_root}/{dataset_name}", exist_ok=True)
+def colorize(mel):
+    r"""Map a spectrogram to an RGBA uint8 image in memory.
+
+    Uses the same default colormap and min/max scaling as ``plt.imsave``, so the
+    result equals what used to be written to and read back from ./temp/mel.png.
+    """
+    return cm.ScalarMappable(cmap=None).to_rgba(mel, bytes=True)
+
 
-        if i == MAX_SAMPLE:
+def read_frames(video_capture, frame_sequence, v):
+    r"""Decode only the frames listed in ``frame_sequence``.
+
+    Frames in between are skipped with ``grab()`` (no colour conversion), and
+    gaps longer than ``SEEK_GAP`` are jumped over by seeking. Each selected
+    frame is returned once, in increasing frame order.
+    """
+    frame_list = []
+    current_frame = 0
+    for target in sorted(set(frame_sequence)):
+        if SEEK_GAP and target - current_frame > SEEK_GAP:
+            if video_capture.set(cv2.CAP_PROP_POS_FRAMES, target):
+                current_frame = target
+        while current_frame < target:
+            if not video_capture.grab():
+                print(f"Error in reading frame {v}: {current_frame}")
+                return frame_list
+            current_frame += 1
+        ret, frame = video_capture.read()
+        if not ret:
+            print(f"Error in reading frame {v}: {current_frame}")
             break
-        root = f"{video_root}/{dataset_name}"
-        video_list = os.listdir(root)
-        print(f"Handling {dataset_name}...")
-        for j in tqdm(range(len(video_list))):
-            v = video_list[j]
-            # load video
-            video_capture = cv2.VideoCapture(f"{root}/{v}")
-            fps = video_capture.get(cv2.CAP_PROP_FPS)
-            frame_count = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
-
-            # select 10 starting point from frames
-            frame_idx = np.linspace(
-                0,
-                frame_count - WINDOW_LEN - 1,
-                N_EXTRACT,
-                endpoint=True,
-                dtype=np.uint8,
-            ).tolist()
-            frame_idx.sort()
-            # selected frames
-            frame_sequence = [
-                i for num in frame_idx for i in range(num, num + WINDOW_LEN)
-            ]
-            frame_list = []
-            current_frame = 0
-            while current_frame <= frame_sequence[-1]:
-                ret, frame = video_capture.read()
-                if not ret:
-                    print(f"Error in reading frame {v}: {current_frame}")
-                    break
-                if current_frame in frame_sequence:
-                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
-                    frame_list.append(cv2.resize(frame, (500, 500)))  # to floating num
-                current_frame += 1
-            video_capture.release()
-
-            # load audio
-            name = v.split(".")[0]
-            a = f"{audio_root}/{dataset_name}/{name}.wav"
-
-            group = 0
-            get_spectrogram(a)
-            mel = plt.imread("./temp/mel.png") * 255  # load spectrogram (int)
-            mel = mel.astype(np.uint8)
-            mapping = mel.shape[1] / frame_count
-            for i in range(len(frame_list)):
-                idx = i % WINDOW_LEN
-                if idx == 0:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
+        frame_list.append(cv2.resize(frame, (500, 500)))  # to floating num
+        current_frame += 1
+    return frame_list
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def load_manifest(path):
+    r"""Read the manifest into a dict keyed by ``{dataset_name}/{video}``.
+
+    Records are appended as videos finish, so a later record replaces an
+    earlier one and a line cut short by a crash is ignored.
+    """
+    manifest = dict()
+    if not os.path.exists(path):
+        return manifest
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            manifest[record["video"]] = record
+    return manifest
+
+
+def same_params(record):
+    return (
+        record["n_extract"] == N_EXTRACT
+        and record["window_len"] == WINDOW_LEN
+        and record.get("output_format", "png") == OUTPUT_FORMAT
+    )
+
+
+bin_writers = dict()   # per process, the ShardBinWriter of every (output directory, run prefix)
+
+
+def get_bin_writer(dataset_name, prefix):
+    key = (dataset_name, prefix)
+    if key not in bin_writers:
+        bin_writers[key] = ShardBinWriter(
+            f"{output_root}/{dataset_name}", f"{prefix}_{os.getpid()}", SHARD_SIZE
+        )
+    return bin_writers[key]
+
+
+def close_bin_writers():
+    for writer in bin_writers.values():
+        writer.close()
+    bin_writers.clear()
+
+
+def process_video(task):
+    r"""Convert one video into ``{name}_{group}.png`` samples.
+
+    Runs inside a worker process, so any failure is caught and reported back
+    instead of taking the whole pool down. ``previous`` is the manifest record
+    of an earlier run (or None); if the content hash still matches, only the
+    record is refreshed and the video is not converted again.
+
+    With ``OUTPUT_FORMAT = "shard"`` (``prefix`` set) the samples go into shard data files
+    of this process; only their index entries are sent back to the main process, which
+    indexes them in its ShardWriter once the video is complete.
+
+    Returns:
+        (video, manifest record or None, [shard index entry] or None, error message or None)
+    """
+    dataset_name, v, previous, prefix = task
+    entries = [] if prefix is not None else None
+    try:
+        path = f"{video_root}/{dataset_name}/{v}"
+        stat = os.stat(path)
+        record = {
+            "video": f"{dataset_name}/{v}",
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha1": file_hash(path),
+            "n_extract": N_EXTRACT,
+            "window_len": WINDOW_LEN,
+            "output_format": OUTPUT_FORMAT,
+        }
+        if previous is not None and same_params(previous) and previous["sha1"] == record["sha1"]:
+            record["groups"] = previous["groups"]
+        else:
+            bins = get_bin_writer(dataset_name, prefix) if prefix is not None else None
+            record["groups"] = convert_video(dataset_name, v, bins, entries)
+        return v, record, entries, None
+    except Exception as e:
+        return v, None, None, f"{type(e).__name__}: {e}"
+
+
+def remove_stale(dataset_name, v, groups, previous_groups, writer=None):
+    r"""Delete samples left over from an earlier conversion that emitted more groups."""
+    name = v.split(".")[0]
+    for group in range(groups, previous_groups):
+        if writer is not None:
+            writer.delete(f"{name}_{group}.png")
+            continue
+        path = f"{output_root}/{dataset_name}/{name}_{group}.png"
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def convert_video(dataset_name, v, bins=None, entries=None):
+    r"""Write the samples of one video and return how many were produced.
+
+    With a ShardBinWriter ``bins`` the samples are written to its shard data files
+    instead of PNG files, and their index entries are appended to ``entries``.
+    """
+    root = f"{video_root}/{dataset_name}"
+    # load video
+    video_capture = cv2.VideoCapture(f"{root}/{v}")
+    fps = video_capture.get(cv2.CAP_PROP_FPS)
+    frame_count = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    # select 10 starting point from frames
+    frame_idx = np.linspace(
+        0,
+        frame_count - WINDOW_LEN - 1,
+        N_EXTRACT,
+        endpoint=True,
+        dtype=np.uint8,
+    ).tolist()
+    frame_idx.sort()
+    # selected frames
+    frame_sequence = [
+        i for num in frame_idx for i in range(num, num + WINDOW_LEN)
+    ]
+    frame_list = read_frames(video_capture, frame_sequence, v)
+    video_capture.release()
+
+    # load audio
+    name = v.split(".")[0]
+    a = f"{audio_root}/{dataset_name}/{name}.wav"
+
+    group = 0
+    mel = get_spectrogram(a)  # spectrogram as uint8 RGBA
+    mapping = mel.shape[1] / frame_count
+    for i in range(len(frame_list)):
+        idx = i % WINDOW_LEN
+        if idx == 0:
+            try:
+                begin = np.round(frame_sequence[i] * mapping)
+                end = np.round((frame_sequence[i] + WINDOW_LEN) * mapping)
+                sub_mel = cv2.resize(
+                    (mel[:, int(begin) : int(end)]), (500 * WINDOW_LEN, 500)
+                )
+                x = np.concatenate(frame_list[i : i + WINDOW_LEN], axis=1)
+                x = np.concatenate((sub_mel[:, :, :3], x[:, :, :3]), axis=0)
+                if bins is not None:
+                    entries.append(bins.write(f"{name}_{group}.png", x))
+                else:
+                    plt.imsave(
+                        f"{output_root}/{dataset_name}/{name}_{group}.png", x
+                    )
+                group = group + 1
+            except ValueError:
+                print(f"ValueError: {name}")
+                continue
+    return group
+
+
+def process_isolated(task):
+    r"""Run one task in a process of its own, a native crash is reported as its error."""
+    with ProcessPoolExecutor(1) as executor:
+        try:
+            return executor.submit(process_video, task).result()
+        except BrokenProcessPool:
+            return task[1], None, None, "worker process died (native crash or killed)"
+
+
+def process_videos(tasks, num_workers):
+    r"""Yield the result of :func:`process_video` for every task, in completion order.
+
+    At most two tasks per worker are in flight. A worker that dies outside of Python (a
+    cv2/FFmpeg segfault on a corrupt video, the OOM killer) breaks the whole pool; the
+    videos that were in flight then run again one by one in processes of their own, the
+    one that dies again is reported as failed, and a new pool takes the remaining tasks.
+    """
+    if num_workers <= 1:
+        # everything stays in this process
+        yield from map(process_video, tasks)
+        return
+    pending = list(reversed(tasks))
+    while pending:
+        executor = ProcessPoolExecutor(num_workers)
+        in_flight = dict()
+        suspects = []
+        try:
+            while (pending or in_flight) and not suspects:
+                while pending and len(in_flight) < 2 * num_workers:
+                    task = pending.pop()
+                    in_flight[executor.submit(process_video, task)] = task
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = in_flight.pop(future)
+                    try:
+                        yield future.result()
+                    except BrokenProcessPool:
+                        suspects.append(task)
+            if suspects:
+                # the other tasks in flight finished before the break or fail with it
+                for future in list(in_flight):
                     try:
-                        begin = np.round(frame_sequence[i] * mapping)
-                        end = np.round((frame_sequence[i] + WINDOW_LEN) * mapping)
-                        sub_mel = cv2.resize(
-                            (mel[:, int(begin) : int(end)]), (500 * WINDOW_LEN, 500)
-                        )
-                        x = np.concatenate(frame_list[i : i + WINDOW_LEN], axis=1)
-                        # print(x.shape)
-                        # print(sub_mel.shape)
-                        x = np.concatenate((sub_mel[:, :, :3], x[:, :, :3]), axis=0)
-                        # print(x.shape)
-                        plt.imsave(
-                            f"{output_root}/{dataset_name}/{name}_{group}.png", x
-                        )
-                        group = group + 1
-                    except ValueError:
-                        print(f"ValueError: {name}")
+                        yield future.result()
+                    except BrokenProcessPool:
+                        suspects.append(in_flight[future])
+                for task in suspects:
+                    yield process_isolated(task)
+        finally:
+            executor.shutdown(wait=not suspects, cancel_futures=True)
+
+
+def run(num_workers=NUM_WORKERS, resume=RESUME):
+    manifest_path = f"{output_root}/{manifest_name}"
+    manifest = load_manifest(manifest_path) if resume else dict()
+    i = 0
+    failures = []
+    writer = None
+    manifest_file = open(manifest_path, "a")
+    try:
+        for label, dataset_name in labels:
+            if not os.path.exists(dataset_name):
+                os.makedirs(f"{output_root}/{dataset_name}", exist_ok=True)
+
+            if i == MAX_SAMPLE:
+                break
+            root = f"{video_root}/{dataset_name}"
+            video_list = os.listdir(root)
+            tasks = []
+            for v in video_list:
+                previous = manifest.get(f"{dataset_name}/{v}")
+                if previous is not None and same_params(previous):
+                    stat = os.stat(f"{root}/{v}")
+                    if stat.st_size == previous["size"] and stat.st_mtime == previous["mtime"]:
                         continue
-            # print(frame_sequence)
-            # print(frame_count)
-            # print(mel.shape[1])
-            # print(mapping)
-            # exit(0)
-        i += 1
+                tasks.append((dataset_name, v, previous))
+            print(f"Handling {dataset_name}... ({len(video_list) - len(tasks)} already converted)")
+            if OUTPUT_FORMAT == "shard":
+                # the workers write the sample data, this process only the index
+                writer = ShardWriter(f"{output_root}/{dataset_name}")
+                tasks = [task + (writer.prefix,) for task in tasks]
+            else:
+                tasks = [task + (None,) for task in tasks]
+            # one task per video, reported as it completes
+            for v, record, entries, error in tqdm(process_videos(tasks, num_workers), total=len(tasks)):
+                if error is not None:
+                    print(f"Failed {v}: {error}")
+                    failures.append((dataset_name, v, error))
+                    continue
+                if entries:
+                    writer.index(entries)
+                previous = manifest.get(record["video"])
+                if previous is not None:
+                    remove_stale(dataset_name, v, record["groups"], previous["groups"], writer)
+                # written as soon as the video is done, so an interrupted run resumes here
+                manifest_file.write(json.dumps(record) + "\n")
+                manifest_file.flush()
+            if writer is not None:
+                writer.close()
+                writer = None
+            i += 1
+    finally:
+        manifest_file.close()
+        if writer is not None:
+            writer.close()
+        # the data files of a serial run, pool workers flush every sample before it is indexed
+        close_bin_writers()
+
+    if failures:
+        print(f"{len(failures)} videos failed:")
+        for dataset_name, v, error in failures:
+            print(f"  {dataset_name}/{v}: {error}")
+    return failures
 
 
 if __name__ == "__main__":
     if not os.path.exists(output_root):
         os.makedirs(output_root, exist_ok=True)
-    if not os.path.exists("./temp"):
-        os.makedirs("./temp", exist_ok=True)
     run()
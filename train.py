@@ -1,15 +1,11 @@
-import os
 from torch.optim import lr_scheduler
-import tensorflow as tf
-from validate import validate
-from data import create_dataloader
+from validate import predict, compute_metrics, aggregate_videos, video_ids
+from data import create_dataloader, DevicePrefetcher
 from trainer.trainer import Trainer
 from options.train_options import TrainOptions
+from utils import init_distributed, is_main_process, get_world_size, get_local_rank, setup_cpu
 from tqdm import tqdm
 
-# 设置 TensorFlow 日志级别，减少不必要的日志输出
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-tf.get_logger().setLevel('ERROR')
 
 def get_val_opt():
     val_opt = TrainOptions().parse(print_options=False)
@@ -24,28 +20,47 @@ def get_val_opt():
     return val_opt
 
 if __name__ == "__main__":
-    opt = TrainOptions().parse()
+    # single process with `python train.py`, one process per device with `torchrun --nproc_per_node N train.py`
+    opt = TrainOptions().parse(print_options=is_main_process())
+    # before any torch op runs, the inter-op pool can not be resized afterwards
+    worker_cores = setup_cpu(opt.intra_threads, opt.interop_threads, opt.loader_cores)
+    init_distributed(opt.dist_backend)
     val_opt = get_val_opt()
     model = Trainer(opt)
+    if opt.feature_cache:
+        # encode every sample once, the loaders then return features instead of 1120x1120 images;
+        # under torchrun the ranks split the samples, no rank waits for a whole encode pass
+        for o in [opt, val_opt]:
+            encoded = model.cache_features(o)
+            if is_main_process():
+                print(f"{encoded} {o.data_label} samples encoded into {o.feature_cache}")
 
-    data_loader = create_dataloader(opt)
-    val_loader = create_dataloader(val_opt)
+    data_loader = create_dataloader(opt, worker_cores)
+    val_loader = create_dataloader(val_opt, worker_cores)
 
     print("Length of data loader: %d" % (len(data_loader)))
     print("Length of val  loader: %d" % (len(val_loader)))
+    print("Effective batch size: %d" % (opt.batch_size * opt.accum_steps * get_world_size()))
+    val_gpu_ids = [get_local_rank()] if get_world_size() > 1 else opt.gpu_ids
 
     # scheduler = lr_scheduler.ReduceLROnPlateau(model.optimizer, mode='min', factor=0.1, patience=5)
     scheduler = lr_scheduler.ReduceLROnPlateau(model.optimizer, mode='max', factor=0.1, patience=5)
     for epoch in range(opt.epoch):
         model.train()
         print(f"Epoch: {epoch + model.step_bias}")
+        if opt.stream:
+            # numbered like the run being resumed, whose first epoch continues after --skip_batches
+            data_loader.dataset.set_epoch(epoch + model.step_bias, opt.skip_batches if epoch == 0 else 0)
+        elif hasattr(data_loader.sampler, "set_epoch"):
+            # a different shard/shuffle of the data on every epoch
+            data_loader.sampler.set_epoch(epoch)
 
         running_loss = 0.0
 
-        progress_bar = tqdm(data_loader, desc=f"Epoch {epoch + model.step_bias} Training", unit="batch", position=0)
+        batches = DevicePrefetcher(data_loader, model.device) if opt.device_prefetch else data_loader
+        progress_bar = tqdm(batches, desc=f"Epoch {epoch + model.step_bias} Training", unit="batch", position=0,
+                            disable=not is_main_process())
         for i, (img, crops, label) in enumerate(progress_bar):
-            model.total_steps += 1
-
             model.set_input((img, crops, label))
             model.forward()
             loss = model.get_loss()
@@ -60,15 +75,30 @@ if __name__ == "__main__":
             #     print("saving the model at the end of batch %d" % (i+epoch*2953))
             #     model.save_networks("test1_model_bacth_%s.pth" % (i+epoch*2953))
 
-        if epoch % opt.save_epoch_freq == 0:
+        model.flush_gradients()
+
+        if epoch % opt.save_epoch_freq == 0 and is_main_process():
             print("saving the model at the end of epoch %d" % (epoch + model.step_bias))
             model.save_networks("ff_lip_model_epoch_%s.pth" % (epoch + model.step_bias))
 
         model.eval()
-        ap, fpr, fnr, acc = validate(model.model, val_loader, opt.gpu_ids)
-        print(
-            "(Val @ epoch {}) acc: {} ap: {} fpr: {} fnr: {}".format(
-                epoch + model.step_bias, acc, ap, fpr, fnr
+        batches = DevicePrefetcher(val_loader, model.device) if opt.device_prefetch else val_loader
+        y_true, y_pred = predict(model.model, batches, val_gpu_ids, opt.precision)
+        ap, fpr, fnr, acc = compute_metrics(y_true, y_pred)
+        if is_main_process():
+            print(
+                "(Val @ epoch {}) acc: {} ap: {} fpr: {} fnr: {}".format(
+                    epoch + model.step_bias, acc, ap, fpr, fnr
+                )
             )
-        )
+        if opt.video_eval:
+            # the same scores, averaged over the clips of every video
+            v_ap, v_fpr, v_fnr, v_acc = compute_metrics(*aggregate_videos(video_ids(val_loader), y_true, y_pred))
+            if is_main_process():
+                print(
+                    "(Val @ epoch {}, per video) acc: {} ap: {} fpr: {} fnr: {}".format(
+                        epoch + model.step_bias, v_acc, v_ap, v_fpr, v_fnr
+                    )
+                )
+        # the metrics are gathered over all ranks, so every rank takes the same scheduler step
         scheduler.step(acc)
\ No newline at end of file
@@ -116,9 +116,15 @@
 import os
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from contextlib import nullcontext
 from torch.optim import lr_scheduler
+from torch.nn.parallel import DistributedDataParallel
 
+from data import AVLip
+from data.feature_cache import FeatureCache, feature_key, build_feature_cache
 from models import build_model, get_loss
+from utils import get_world_size, get_local_rank
 
 
 class Trainer(nn.Module):
@@ -126,13 +132,32 @@ class Trainer(nn.Module):
         super().__init__()
         self.opt = opt
         self.total_steps = 0
+        # effective batch size is batch_size * accum_steps, total_steps counts optimizer steps
+        self.accum_steps = opt.accum_steps
+        self.micro_step = 0
         self.save_dir = os.path.join(opt.checkpoints_dir, opt.name)
         self.device = (
             torch.device("cuda:{}".format(opt.gpu_ids[0]))
             if opt.gpu_ids and torch.cuda.is_available()
             else torch.device("cpu")
         )
+        if get_world_size() > 1 and torch.cuda.is_available():
+            # one process per gpu under torchrun
+            self.device = torch.device("cuda", get_local_rank())
         self.model = build_model(opt.arch)
+        self.model.backbone.fold_batch = opt.fold_batch
+        self.model.set_grad_checkpointing(opt.grad_ckpt)
+
+        assert opt.precision in ["fp32", "fp16", "bf16"]
+        if opt.precision == "fp16" and self.device.type != "cuda":
+            raise ValueError("fp16 autocast needs a cuda device, use bf16 on cpu")
+        self.amp_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(opt.precision)
+        if self.amp_dtype is not None:
+            # clip.load keeps fp16 weights on cuda, under autocast the encoder is fp32 like the rest of the model
+            # and every op runs in amp_dtype, instead of mixing fp16 weights with bf16 activations
+            self.model.encoder.float()
+        # bf16 has the range of fp32, only fp16 gradients need scaling
+        self.scaler = torch.cuda.amp.GradScaler(enabled=opt.precision == "fp16")
 
         self.step_bias = (
             0
@@ -145,10 +170,14 @@ class Trainer(nn.Module):
             self.total_steps = state_dict["total_steps"]
             print(f"Model loaded @ {opt.pretrained_model.split('/')[-1]}")
 
+        if opt.feature_cache and not (opt.fix_encoder and opt.fix_stem):
+            raise ValueError("--feature_cache needs a frozen encoder and stem (--fix_stem)")
+
         if opt.fix_encoder:
+            frozen = ["encoder", "conv1"] if opt.fix_stem else ["encoder"]
             trainable_params = []
             for name, p in self.model.named_parameters():
-                if name.split(".")[0] in ["encoder"]:
+                if name.split(".")[0] in frozen:
                     p.requires_grad = False
                 else:
                     p.requires_grad = True
@@ -174,6 +203,12 @@ class Trainer(nn.Module):
         self.criterion = get_loss().to(self.device)
         self.criterion1 = nn.BCEWithLogitsLoss().to(self.device)
         self.model.to(self.device)
+        # self.net runs the forward pass, self.model is the plain LipFD that gets saved
+        self.net = self.model
+        if get_world_size() > 1:
+            self.net = DistributedDataParallel(
+                self.model, device_ids=[self.device.index] if self.device.type == "cuda" else None
+            )
 
         self.scheduler = lr_scheduler.ReduceLROnPlateau(
         self.optimizer,
@@ -185,34 +220,68 @@ class Trainer(nn.Module):
         )
 
     def set_input(self, input):
-        self.input = input[0].to(self.device)
-        self.crops = [[t.to(self.device) for t in sublist] for sublist in input[1]]
+        self.input = input[0].to(self.device, non_blocking=True)
+        # (batch_size, 3 regions, 5 frames, 3, 224, 224) in a single copy
+        self.crops = input[1].to(self.device, non_blocking=True)
         # self.label = input[2].to(self.device)
         self.label = input[2].to(self.device).float()
 
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
     def forward(self):
-        self.get_features()
-        self.output, self.weights_max, self.weights_org = self.model.forward(
-            self.crops, self.features
-        )                                           #此处features是对输入LipFD.get_features的结果
-        self.output = self.output.view(-1)
-        self.loss =1 * self.criterion(
-            self.weights_max, self.weights_org
-        ) + 10 * self.criterion1(self.output, self.label)
+        # gradients are only all-reduced on the last micro-batch of an accumulation
+        sync = self.net is self.model or (self.micro_step + 1) % self.accum_steps == 0
+        with self.autocast(), nullcontext() if sync else self.net.no_sync():
+            # LipFD encodes self.input itself, 2-D inputs are cached global features
+            self.output, self.weights_max, self.weights_org = self.net(
+                self.crops, self.input
+            )
+            self.output = self.output.view(-1)
+            self.loss =1 * self.criterion(
+                self.weights_max, self.weights_org
+            ) + 10 * self.criterion1(self.output, self.label)
 
     def get_loss(self):
         loss = self.loss.data.tolist()
         return loss[0] if isinstance(loss, type(list())) else loss
 
     def optimize_parameters(self):
+        # the loss of every micro-batch is scaled so that the accumulated gradient is the mean over the batch
+        self.scaler.scale(self.loss / self.accum_steps).backward()
+        self.micro_step += 1
+        if self.micro_step % self.accum_steps == 0:
+            self.step()
+
+    def step(self):
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
         self.optimizer.zero_grad()
-        self.loss.backward()
-        self.optimizer.step()
+        self.total_steps += 1
+
+    def flush_gradients(self):
+        r"""Apply the gradients of an incomplete accumulation, e.g. at the end of an epoch."""
+        pending = self.micro_step % self.accum_steps
+        if pending:
+            if self.net is not self.model:
+                # these micro-batches ran under no_sync
+                for p in self.model.parameters():
+                    if p.grad is not None:
+                        dist.all_reduce(p.grad)
+                        p.grad.div_(get_world_size())
+            # rescale the sum of ``pending`` micro-batches to their mean
+            for group in self.optimizer.param_groups:
+                for p in group["params"]:
+                    if p.grad is not None:
+                        p.grad.mul_(self.accum_steps / pending)
+            self.step()
+        self.micro_step = 0
 
-    def get_features(self):
-        self.features = self.model.get_features(self.input).to(
-            self.device
-        )  # shape: (batch_size
+    def cache_features(self, opt):
+        r"""Fill opt.feature_cache with the global features of the dataset of ``opt``."""
+        opt.feature_key = feature_key(self.model)
+        cache = FeatureCache(opt.feature_cache, opt.feature_key)
+        return build_feature_cache(self.model, AVLip(opt), cache, self.device, opt.batch_size)
 
     def eval(self):
         self.model.eval()
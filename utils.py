@@ -1,4 +1,6 @@
 import os
+import torch
+import torch.distributed as dist
 
 def get_list(path) -> list:
     r"""Recursively read all files in root path"""
@@ -7,4 +9,77 @@ def get_list(path) -> list:
         for f in files:
             if f.split('.')[1] in ['png', 'jpg', 'jpeg']:
                 image_list.append(os.path.join(root, f))
-    return image_list
\ No newline at end of file
+    return image_list
+
+
+# torchrun sets RANK/LOCAL_RANK/WORLD_SIZE, a plain `python train.py` is a world of one process
+def get_world_size() -> int:
+    return int(os.environ.get("WORLD_SIZE", 1))
+
+
+def get_rank() -> int:
+    return int(os.environ.get("RANK", 0))
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def get_local_world_size() -> int:
+    return int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(backend=""):
+    r"""Join the process group started by torchrun, nothing to do in a single process"""
+    if get_world_size() == 1 or dist.is_initialized():
+        return
+    backend = backend or ("nccl" if torch.cuda.is_available() else "gloo")
+    if backend == "nccl":
+        torch.cuda.set_device(get_local_rank())
+    dist.init_process_group(backend)
+
+
+def gather_list(values) -> list:
+    r"""Concatenate the lists of all ranks, in rank order"""
+    if get_world_size() == 1:
+        return list(values)
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, list(values))
+    return [v for part in gathered for v in part]
+
+
+def barrier():
+    if get_world_size() > 1:
+        dist.barrier()
+
+
+def setup_cpu(intra_threads=0, interop_threads=0, loader_cores=0) -> list:
+    r"""Thread counts and cpu affinity of this process, returns the cores left for DataLoader workers"""
+    worker_cores = []
+    if loader_cores and hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        # under torchrun the processes of a node split its cores, each keeps loader_cores of its share
+        n, local_rank = get_local_world_size(), get_local_rank()
+        cores = cores[len(cores) * local_rank // n:len(cores) * (local_rank + 1) // n]
+        if len(cores) > loader_cores:
+            worker_cores = cores[-loader_cores:]
+            os.sched_setaffinity(0, cores[:-loader_cores])
+            if not intra_threads:
+                # the intra-op pool was sized for all cores when torch was imported
+                intra_threads = len(cores) - loader_cores
+    if intra_threads:
+        torch.set_num_threads(intra_threads)
+    if interop_threads:
+        # only possible before the first parallel op of the process
+        torch.set_num_interop_threads(interop_threads)
+    return worker_cores
+
+
+def pin_worker(cores, worker_id):
+    r"""DataLoader worker_init_fn, keeps the workers off the cores of the training process"""
+    if cores:
+        os.sched_setaffinity(0, cores)
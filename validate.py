@@ -1,32 +1,68 @@
+import os
+import json
 import argparse
 import torch
 import numpy as np
+from numpy.lib.format import open_memmap
 from data import AVLip
+from functools import partial
+from utils import gather_list, is_main_process, setup_cpu, pin_worker
 import torch.utils.data
 from models import build_model
+from models.region_awareness import get_backbone
+from data.feature_cache import FeatureCache, feature_key, build_feature_cache
 from sklearn.metrics import average_precision_score, confusion_matrix, accuracy_score
 from tqdm import tqdm
 
 
-def validate(model, loader, gpu_id):
+def validate(model, loader, gpu_id, precision="fp32", video_level=False):
+    r"""Metrics of ``model`` on ``loader``, per clip or, with ``video_level``, per video."""
+    y_true, y_pred = predict(model, loader, gpu_id, precision)
+    if video_level:
+        y_true, y_pred = aggregate_videos(video_ids(loader), y_true, y_pred)
+    return compute_metrics(y_true, y_pred)
+
+
+def predict(model, loader, gpu_id, precision="fp32"):
+    r"""Labels and fake scores of all samples of ``loader``, gathered over the ranks."""
     print("validating...")
     device = torch.device(f"cuda:{gpu_id[0]}" if torch.cuda.is_available() else "cpu")
-    with torch.no_grad():
+    amp_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(precision)
+    with torch.no_grad(), torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
         y_true, y_pred = [], []
-        for img, crops, label in tqdm(loader, desc="Validation Progress"):
-            img_tens = img.to(device)
-            crops_tens = [[t.to(device) for t in sublist] for sublist in crops]
-            features = model.get_features(img_tens).to(device)
-
-            y_pred.extend(model(crops_tens, features)[0].sigmoid().flatten().tolist())
+        for img, crops, label in tqdm(loader, desc="Validation Progress", disable=not is_main_process()):
+            img_tens = img.to(device, non_blocking=True)
+            crops_tens = crops.to(device, non_blocking=True)
+            # LipFD encodes the images, 2-D inputs are cached global features
+            y_pred.extend(model(crops_tens, img_tens)[0].float().sigmoid().flatten().tolist())
             y_true.extend(label.flatten().tolist())
 
+    # under torchrun every rank validated its own shard of the loader
+    return gather_list(y_true), gather_list(y_pred)
+
+
+def video_ids(loader):
+    r"""Video id of every sample in the order :func:`predict` returns them, needs an unshuffled loader."""
+    # the sampler yields its fixed order of dataset indices once more
+    indices = np.array(gather_list(loader.sampler), dtype=np.int64)
+    return loader.dataset.video_ids[indices]
+
+
+def aggregate_videos(video_ids, y_true, y_score):
+    r"""Mean clip score and label of every video, in video id order."""
+    videos, inverse, counts = np.unique(video_ids, return_inverse=True, return_counts=True)
+    y_score = np.bincount(inverse, weights=y_score) / counts
+    y_true = np.round(np.bincount(inverse, weights=y_true) / counts)
+    return y_true.tolist(), y_score.tolist()
+
+
+def compute_metrics(y_true, y_score, threshold=0.5):
     y_true = np.array(y_true)
-    y_pred = np.where(np.array(y_pred) >= 0.5, 1, 0)
+    y_pred = np.where(np.array(y_score) >= threshold, 1, 0)
 
     # Get AP
     ap = average_precision_score(y_true, y_pred)
-    cm = confusion_matrix(y_true, y_pred)
+    cm = confusion_matrix(y_true, y_pred, labels=[0, 1])
     tp, fn, fp, tn = cm.ravel()
     fnr = fn / (fn + tp)
     fpr = fp / (fp + tn)
@@ -35,6 +71,84 @@ def validate(model, loader, gpu_id):
     return ap, fpr, fnr, acc
 
 
+"""
+Embedding store written by --export_embeddings, everything the head needs for each sample:
+<root>
+├── global.npy      (N, 768) CLIP global features
+├── regions.npy     (N, 3, 5, 2048) pooled ResNet features of the head/face/mouth crops of each frame
+├── lip.npy         (N, 256) lip LSTM outputs
+├── labels.npy      (N,) 0 real, 1 fake
+└── samples.json    {"names": [...], "ckpt": ...}, row i is names[i]
+"""
+
+
+def export_embeddings(model, dataset, root, device, batch_size=5, ckpt=""):
+    if len(dataset) == 0:
+        raise ValueError("no samples to export, check --real_list_path and --fake_list_path")
+    os.makedirs(root, exist_ok=True)
+    if os.path.exists(os.path.join(root, "samples.json")):
+        os.remove(os.path.join(root, "samples.json"))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    arrays = None
+    start = 0
+    with torch.no_grad():
+        for img, crops, label in tqdm(loader, desc="Exporting embeddings"):
+            img_tens = img.to(device, non_blocking=True)
+            crops_tens = crops.to(device, non_blocking=True)
+            features = img_tens if img_tens.dim() == 2 else model.get_features(img_tens)
+            regions, lip = model.backbone.embed(crops_tens)
+            # (regions, frames, batch_size, 2048) -> (batch_size, regions, frames, 2048)
+            batch = {
+                "global": features, "regions": regions.permute(2, 0, 1, 3), "lip": lip, "labels": label,
+            }
+            if arrays is None:
+                arrays = {
+                    name: open_memmap(os.path.join(root, name + ".npy"), mode="w+", dtype=np.float32,
+                                      shape=(len(dataset),) + tuple(t.shape[1:]))
+                    for name, t in batch.items()
+                }
+            end = start + len(label)
+            for name, t in batch.items():
+                arrays[name][start:end] = t.float().cpu().numpy()
+            start = end
+    for array in arrays.values():
+        array.flush()
+    # names are written last, a directory with samples.json always holds a complete export
+    with open(os.path.join(root, "samples.json"), "w") as f:
+        json.dump({"names": dataset.total_list, "ckpt": ckpt}, f)
+    return start
+
+
+def evaluate_embeddings(backbone, root, ckpt, batch_size=1024):
+    r"""Rerun only the head of ``backbone`` (loaded from ``ckpt``) on an exported store, returns (y_true, y_score)."""
+    index_path = os.path.join(root, "samples.json")
+    if not os.path.exists(index_path):
+        raise ValueError(f"{root} holds no complete export (no samples.json), export it again")
+    with open(index_path) as f:
+        exported_ckpt = json.load(f)["ckpt"]
+    # the embeddings come from the stem, encoder and region backbone of that checkpoint
+    if os.path.realpath(exported_ckpt) != os.path.realpath(ckpt):
+        raise ValueError(f"{root} was exported with {exported_ckpt}, not {ckpt}")
+    arrays = {name: np.load(os.path.join(root, name + ".npy"), mmap_mode="r") for name in ["global", "regions", "lip"]}
+    y_true = np.load(os.path.join(root, "labels.npy")).tolist()
+    y_score = []
+    device = next(backbone.parameters()).device
+    with torch.no_grad():
+        for start in range(0, len(y_true), batch_size):
+            batch = {name: torch.from_numpy(np.array(a[start:start + batch_size])).to(device) for name, a in arrays.items()}
+            regions = batch["regions"].permute(1, 2, 0, 3)
+            y_score.extend(backbone.head(regions, batch["lip"], batch["global"])[0].sigmoid().flatten().tolist())
+    return y_true, y_score
+
+
+def load_backbone(ckpt):
+    r"""Only the region backbone of a LipFD checkpoint, enough for :func:`evaluate_embeddings`."""
+    state_dict = torch.load(ckpt, map_location="cpu")["model"]
+    backbone = get_backbone()
+    backbone.load_state_dict({k[len("backbone."):]: v for k, v in state_dict.items() if k.startswith("backbone.")})
+    return backbone.eval()
+
+
 # def validate(model, loader, gpu_id):
 #     print("validating...")
 #     device = torch.device(f"cuda:{gpu_id[0]}" if torch.cuda.is_available() else "cpu")
@@ -66,32 +180,72 @@ if __name__ == "__main__":
     # parser.add_argument("--fake_list_path", type=str, default="./datasets/val/1_fake")
     parser.add_argument("--real_list_path", type=str, default="/root/autodl-tmp/val_final/0_real")
     parser.add_argument("--fake_list_path", type=str, default="/root/autodl-tmp/val_final/1_fake")
+    parser.add_argument("--detector", type=str, default="facenet", help="facenet, mtcnn or none")
+    parser.add_argument("--detection_cache", type=str, default="", help="face detection cache, empty to always run MTCNN")
+    parser.add_argument("--feature_cache", type=str, default="", help="directory of cached global CLIP features, empty to run the encoder")
     parser.add_argument("--max_sample", type=int, default=1000, help="max number of validate samples")
     parser.add_argument("--batch_size", type=int, default=5)
+    parser.add_argument("--precision", type=str, default="fp32", help="fp32, fp16 (cuda only) or bf16 autocast")
+    parser.add_argument("--fold_batch", action="store_true", help="run the region backbone and LipCNN once over all regions and frames")
     parser.add_argument("--data_label", type=str, default="val")
+    parser.add_argument("--data_format", type=str, default="png", help="png, shard or memmap")
     parser.add_argument("--arch", type=str, default="CLIP:ViT-L/14")
     # parser.add_argument("--ckpt", type=str, default="/tmp/pycharm_project_76/checkpoints/model_epoch_0.pth")
     parser.add_argument("--ckpt", type=str, default="/root/autodl-tmp/checkpoints/experiment_name/ff_lip_model_epoch_3.pth")
     parser.add_argument("--gpu", type=int, default=0)
+    parser.add_argument("--num_threads", type=int, default=0, help="# DataLoader workers")
+    parser.add_argument("--intra_threads", type=int, default=0, help="threads of every torch op on the cpu, 0 keeps the PyTorch default")
+    parser.add_argument("--interop_threads", type=int, default=0, help="threads running independent torch ops in parallel, 0 keeps the PyTorch default")
+    parser.add_argument("--loader_cores", type=int, default=0, help="pin the DataLoader workers to this many cpu cores and inference to the others")
+    parser.add_argument("--export_embeddings", type=str, default="", help="write global/region/lip embeddings of the dataset to this directory, then evaluate from them")
+    parser.add_argument("--embeddings", type=str, default="", help="evaluate only the head of --ckpt on embeddings exported earlier, without CLIP or the dataset")
+    parser.add_argument("--video_level", action="store_true", help="metrics on the mean clip score of every video")
+    parser.add_argument("--thresholds", type=str, default="0.5", help="comma separated decision thresholds, e.g. 0.3,0.5,0.7")
 
     opt = parser.parse_args()
+    worker_cores = setup_cpu(opt.intra_threads, opt.interop_threads, opt.loader_cores)
+    thresholds = [float(t) for t in opt.thresholds.split(",")]
 
     device = torch.device(f"cuda:{opt.gpu}" if torch.cuda.is_available() else "cpu")
     print(f"Using cuda {opt.gpu} for inference.")
 
-    model = build_model(opt.arch)
-    state_dict = torch.load(opt.ckpt, map_location="cpu")
-    model.load_state_dict(state_dict["model"])
-    print("Model loaded.")
-    model.eval()
-    model.to(device)
-
-    dataset = AVLip(opt)
-    loader = data_loader = torch.utils.data.DataLoader(
-        dataset, batch_size=opt.batch_size, shuffle=True
-    )
-    ap, fpr, fnr, acc = validate(model, loader, gpu_id=[opt.gpu])
-    print(f"acc: {acc} ap: {ap} fpr: {fpr} fnr: {fnr}")
+    if opt.embeddings:
+        backbone = load_backbone(opt.ckpt).to(device)
+        y_true, y_score = evaluate_embeddings(backbone, opt.embeddings, opt.ckpt)
+    else:
+        model = build_model(opt.arch)
+        state_dict = torch.load(opt.ckpt, map_location="cpu")
+        model.load_state_dict(state_dict["model"])
+        model.backbone.fold_batch = opt.fold_batch
+        print("Model loaded.")
+        model.eval()
+        model.to(device)
+        if opt.precision != "fp32":
+            # fp32 encoder weights, autocast picks the precision of every op
+            model.encoder.float()
+
+        if opt.feature_cache:
+            opt.feature_key = feature_key(model)
+            cache = FeatureCache(opt.feature_cache, opt.feature_key)
+            print(f"{build_feature_cache(model, AVLip(opt), cache, device, opt.batch_size)} samples encoded")
+        dataset = AVLip(opt)
+        if opt.export_embeddings:
+            exported = export_embeddings(model, dataset, opt.export_embeddings, device, opt.batch_size, opt.ckpt)
+            print(f"{exported} samples exported to {opt.export_embeddings}")
+            y_true, y_score = evaluate_embeddings(model.backbone, opt.export_embeddings, opt.ckpt)
+        else:
+            loader = data_loader = torch.utils.data.DataLoader(
+                dataset, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_threads,
+                worker_init_fn=partial(pin_worker, worker_cores) if worker_cores else None,
+            )
+            ap, fpr, fnr, acc = validate(model, loader, gpu_id=[opt.gpu], precision=opt.precision, video_level=opt.video_level)
+            print(f"acc: {acc} ap: {ap} fpr: {fpr} fnr: {fnr}")
+
+    if opt.embeddings or opt.export_embeddings:
+        # the scores are computed once, every threshold only re-thresholds them
+        for threshold in thresholds:
+            ap, fpr, fnr, acc = compute_metrics(y_true, y_score, threshold)
+            print(f"threshold: {threshold} acc: {acc} ap: {ap} fpr: {fpr} fnr: {fnr}")
 
     #python validate.py --real_list_path. /datasets/val/0_real --fake_list_path./datasets/val/ 1_fake --ckpt./checkpoints/experiment_name/model_epoch_1.pth
  #acc: 0.5455079271873166 ap: 0.5237604866940078 fpr: 0.8393598103141672 fnr: 0.07678883071553229
\ No newline at end of file